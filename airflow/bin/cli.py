@@ -7,6 +7,7 @@ from airflow import settings
 from airflow import utils
 from airflow import jobs
 from airflow.models import DagBag, TaskInstance, DagPickle
+from airflow.models import FileEventLogSink, get_event_log_folder
 
 import dateutil.parser
 from datetime import datetime
@@ -36,7 +37,7 @@ def log_to_stdout():
 
 def backfill(args):
     logging.basicConfig(level=logging.INFO, format=settings.SIMPLE_LOG_FORMAT)
-    dagbag = DagBag(args.subdir)
+    dagbag = DagBag.for_dag(args.dag_id, args.subdir)
     if args.dag_id not in dagbag.dags:
         raise Exception('dag_id could not be found')
     dag = dagbag.dags[args.dag_id]
@@ -83,7 +84,7 @@ def run(args):
         level=logging.INFO,
         format=settings.LOG_FORMAT)
     if not args.pickle:
-        dagbag = DagBag(subdir)
+        dagbag = DagBag.for_dag(args.dag_id, subdir)
         if args.dag_id not in dagbag.dags:
             msg = 'DAG [{0}] could not be found'.format(args.dag_id)
             logging.error(msg)
@@ -157,7 +158,7 @@ def task_state(args):
     success
     """
     args.execution_date = dateutil.parser.parse(args.execution_date)
-    dagbag = DagBag(args.subdir)
+    dagbag = DagBag.for_dag(args.dag_id, args.subdir)
     if args.dag_id not in dagbag.dags:
         raise Exception('dag_id could not be found')
     dag = dagbag.dags[args.dag_id]
@@ -171,8 +172,37 @@ def list_dags(args):
     print("\n".join(sorted(dagbag.dags)))
 
 
+def dag_report(args):
+    dagbag = DagBag(args.subdir, include_examples=False, parse_cache=False)
+    stats = sorted(
+        dagbag.file_stats.values(), key=lambda s: s['duration'],
+        reverse=True)
+    row = "{:<60} {:>10} {:>6} {:>7} {:>12}  {}"
+    print(row.format(
+        "file", "duration", "dags", "tasks", "maxrss_kb+", "status"))
+    for s in stats:
+        status = 'ok'
+        if s['timed_out']:
+            status = 'timed out'
+        elif s['failed']:
+            status = 'failed'
+        print(row.format(
+            os.path.relpath(s['filepath'], args.subdir)
+            if os.path.isdir(args.subdir) else s['filepath'],
+            "{:.3f}s".format(s['duration']),
+            s['dag_count'], s['task_count'], s['maxrss_delta_kb'], status))
+    print("{} files parsed in {:.3f}s".format(
+        len(stats), sum([s['duration'] for s in stats])))
+
+
+def ship_event_logs(args):
+    folder = args.folder or get_event_log_folder()
+    count = FileEventLogSink.ship(folder)
+    print("{} events loaded from {}".format(count, folder))
+
+
 def list_tasks(args):
-    dagbag = DagBag()
+    dagbag = DagBag.for_dag(args.dag_id)
     if args.dag_id not in dagbag.dags:
         raise Exception('dag_id could not be found')
     dag = dagbag.dags[args.dag_id]
@@ -186,7 +216,7 @@ def list_tasks(args):
 def test(args):
     log_to_stdout()
     args.execution_date = dateutil.parser.parse(args.execution_date)
-    dagbag = DagBag(args.subdir)
+    dagbag = DagBag.for_dag(args.dag_id, args.subdir)
     if args.dag_id not in dagbag.dags:
         raise Exception('dag_id could not be found')
     dag = dagbag.dags[args.dag_id]
@@ -197,7 +227,7 @@ def test(args):
 
 def clear(args):
     logging.basicConfig(level=logging.INFO, format=settings.SIMPLE_LOG_FORMAT)
-    dagbag = DagBag(args.subdir)
+    dagbag = DagBag.for_dag(args.dag_id, args.subdir)
 
     if args.dag_id not in dagbag.dags:
         raise Exception('dag_id could not be found')
@@ -246,7 +276,12 @@ def webserver(args):
 def scheduler(args):
     print(settings.HEADER)
     log_to_stdout()
-    job = jobs.SchedulerJob(args.dag_id, args.subdir)
+    job = jobs.SchedulerJob(
+        args.dag_id, args.subdir,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        dynamic_shards=args.dynamic_shards,
+        num_runs=args.num_runs)
     job.run()
 
 
@@ -471,6 +506,20 @@ def get_parser():
     parser_scheduler.add_argument(
         "-sd", "--subdir", help=subdir_help,
         default=DAGS_FOLDER)
+    parser_scheduler.add_argument(
+        "-sc", "--shard_count", type=int,
+        help="Split the DAGs across this many schedulers")
+    parser_scheduler.add_argument(
+        "-si", "--shard_index", type=int,
+        help="The shard of this scheduler, from 0 to shard_count - 1")
+    ht = (
+        "Split the DAGs across all the schedulers running with this flag, "
+        "taking over the DAGs of the ones that die")
+    parser_scheduler.add_argument(
+        "-ds", "--dynamic_shards", help=ht, action="store_true")
+    parser_scheduler.add_argument(
+        "-n", "--num_runs", type=int,
+        help="Stop after this many scheduler loops")
     parser_scheduler.set_defaults(func=scheduler)
 
     ht = "Initialize the metadata database"
@@ -485,6 +534,20 @@ def get_parser():
     parser_list_dags = subparsers.add_parser('list_dags', help=ht)
     parser_list_dags.set_defaults(func=list_dags)
 
+    ht = "Import the DAG files and report how long each one took to parse"
+    parser_dag_report = subparsers.add_parser('dag_report', help=ht)
+    parser_dag_report.add_argument(
+        "-sd", "--subdir", help=subdir_help,
+        default=DAGS_FOLDER)
+    parser_dag_report.set_defaults(func=dag_report)
+
+    ht = "Load the task instance events written to files into the database"
+    parser_ship_event_logs = subparsers.add_parser(
+        'ship_event_logs', help=ht)
+    parser_ship_event_logs.add_argument(
+        "-f", "--folder", help="Folder the event files were written to")
+    parser_ship_event_logs.set_defaults(func=ship_event_logs)
+
     ht = "List the tasks whithin a DAG"
     parser_list_tasks = subparsers.add_parser('list_tasks', help=ht)
     parser_list_tasks.add_argument(
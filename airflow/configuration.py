@@ -7,6 +7,18 @@ defaults = {
     'core': {
         'unit_test_mode': False,
         'parallelism': 32,
+        'max_active_runs_per_dag': 16,
+        'dagbag_parse_processes': 1,
+        'dagbag_import_timeout': 30,
+        'dag_parse_cache': 'none',
+        'dag_parse_cache_folder': '',
+        'store_serialized_dags': False,
+        'dag_freshness_ttl': 5,
+        'template_cache_size': 400,
+        'event_log_sink': 'database',
+        'event_log_flush_interval': 5,
+        'event_log_folder': '',
+        'task_resource_sample_interval': 1,
         'load_examples': True,
     },
     'webserver': {
@@ -22,6 +34,10 @@ defaults = {
         'job_heartbeat_sec': 5,
         'scheduler_heartbeat_sec': 60,
         'authenticate': False,
+        'dag_processes': 1,
+        'wakeup_host': 'localhost',
+        'wakeup_port': 8794,
+        'dag_folder_watch': False,
     },
     'celery': {
         'default_queue': 'default',
@@ -36,6 +52,38 @@ base_log_folder = {AIRFLOW_HOME}/logs
 executor = SequentialExecutor
 sql_alchemy_conn = sqlite:///{AIRFLOW_HOME}/airflow.db
 parallelism = 32
+max_active_runs_per_dag = 16
+# Number of processes DAG files are parsed in, files are imported serially
+# when set to 1
+dagbag_parse_processes = 1
+# Number of seconds after which importing a DAG file is abandoned, the DAGs
+# previously loaded from it are kept. 0 disables the timeout
+dagbag_import_timeout = 30
+# Reuse the DAGs parsed out of a file as long as its content and the content
+# of the local modules it imports don't change: none, memory or disk. Files
+# or templates read at import time aren't tracked
+dag_parse_cache = none
+dag_parse_cache_folder = {AIRFLOW_HOME}/dag_parse_cache
+# Whether the scheduler stores a serialization of the DAGs in the database
+# for the webserver to render them without importing the DAG files
+store_serialized_dags = False
+# Number of seconds the DAGs' expiry dates (set when a DAG is refreshed from
+# the UI) are cached for before DagBags check them again
+dag_freshness_ttl = 5
+# Number of compiled templates and template files each DAG keeps in memory
+template_cache_size = 400
+# Where the events of the task instances (the log table) get written:
+# database writes them along with the state changes, buffered writes them
+# to the database in bulk every event_log_flush_interval seconds and at
+# exit, file writes them to event_log_folder, from where
+# `airflow ship_event_logs` loads them into the database
+event_log_sink = database
+event_log_flush_interval = 5
+event_log_folder = {AIRFLOW_HOME}/event_logs
+# Number of seconds between the samples of the resources (memory, IO) used
+# by the process tree of a task instance, taken from /proc. 0 disables the
+# sampling, CPU times are recorded regardless
+task_resource_sample_interval = 1
 load_examples = True
 
 [webserver]
@@ -62,6 +110,18 @@ default_queue = default
 [scheduler]
 job_heartbeat_sec = 5
 scheduler_heartbeat_sec = 60
+dag_processes = 1
+# Task instances reaching a terminal state notify the scheduler on this
+# UDP address so that it doesn't wait for its next heartbeat, set the port
+# to 0 to disable. When workers run on other machines, set wakeup_host to
+# the scheduler's host name in their airflow.cfg, with localhost only the
+# task instances running on the scheduler's machine reach it
+wakeup_host = localhost
+wakeup_port = 8794
+# Watch the DAG folder (with inotify on Linux) so that every scheduler loop
+# only processes the DAG files that changed instead of walking the folder.
+# Network file systems may not report changes to inotify
+dag_folder_watch = False
 """
 
 TEST_CONFIG = """\
@@ -134,6 +194,9 @@ class ConfigParserWithDefaults(ConfigParser):
     def getint(self, section, key):
         return int(self.get(section, key))
 
+    def getfloat(self, section, key):
+        return float(self.get(section, key))
+
 
 
 def mkdir_p(path):
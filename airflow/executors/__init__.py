@@ -1,19 +1,30 @@
 import logging
 
 from airflow.configuration import conf
-from airflow.executors.local_executor import LocalExecutor
-from airflow.executors.celery_executor import CeleryExecutor
-from airflow.executors.sequential_executor import SequentialExecutor
+from airflow.utils import lazy_module_attrs as _lazy_module_attrs
+
+_executors = {
+    'local_executor': ['LocalExecutor'],
+    'celery_executor': ['CeleryExecutor'],
+    'sequential_executor': ['SequentialExecutor'],
+}
 
 _EXECUTOR = conf.get('core', 'EXECUTOR')
 
+# Only the configured executor is imported upfront, the others and the
+# libraries they depend on, like celery, are imported when accessed
 if _EXECUTOR == 'LocalExecutor':
+    from airflow.executors.local_executor import LocalExecutor
     DEFAULT_EXECUTOR = LocalExecutor()
 elif _EXECUTOR == 'CeleryExecutor':
+    from airflow.executors.celery_executor import CeleryExecutor
     DEFAULT_EXECUTOR = CeleryExecutor()
 elif _EXECUTOR == 'SequentialExecutor':
+    from airflow.executors.sequential_executor import SequentialExecutor
     DEFAULT_EXECUTOR = SequentialExecutor()
 else:
     raise Exception("Executor {0} not supported.".format(_EXECUTOR))
 
 logging.info("Using executor " + _EXECUTOR)
+
+_lazy_module_attrs(__name__, _executors, qualified=True)
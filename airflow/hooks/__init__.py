@@ -1,8 +1,9 @@
 '''
 Imports the hooks dynamically while keeping the package API clean,
-abstracting the underlying modules
+abstracting the underlying modules. A module is only imported once one of
+its hooks is accessed
 '''
-from airflow.utils import import_module_attrs as _import_module_attrs
+from airflow.utils import lazy_module_attrs as _lazy_module_attrs
 
 _hooks = {
     'hive_hooks': [
@@ -19,4 +20,4 @@ _hooks = {
     'S3_hook': ['S3Hook'],
 }
 
-_import_module_attrs(globals(), _hooks)
+_lazy_module_attrs(__name__, _hooks)
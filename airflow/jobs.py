@@ -1,15 +1,21 @@
-from collections import defaultdict
-from datetime import datetime
+import bisect
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import getpass
+import hashlib
 import logging
+import multiprocessing
+import select
 import signal
 import subprocess
 import sys
+import threading
 from time import sleep
 
 from sqlalchemy import (
     Column, Integer, String, DateTime)
-from sqlalchemy import func, Index
+from sqlalchemy import and_, func, or_, text, Index
 from sqlalchemy.orm.session import make_transient
 
 from airflow import executors
@@ -24,14 +30,7 @@ from airflow.utils import State
 Base = models.Base
 ID_LEN = models.ID_LEN
 
-# Setting up a statsd client if needed
-statsd = None
-if conf.get('scheduler', 'statsd_on'):
-    from statsd import StatsClient
-    statsd = StatsClient(
-        host=conf.get('scheduler', 'statsd_host'),
-        port=conf.getint('scheduler', 'statsd_port'),
-        prefix='airflow')
+statsd = settings.statsd
 
 
 class BaseJob(Base):
@@ -106,6 +105,13 @@ class BaseJob(Base):
     def heartbeat_callback(self):
         pass
 
+    def heartbeat_wait(self, seconds):
+        '''
+        Waits for the next heartbeat to be due. Jobs that can make use of
+        the time in between, or that should wake up early, override this.
+        '''
+        sleep(seconds)
+
     def heartbeat(self):
         '''
         Heartbeats update the job's entry in the the database with a timestamp
@@ -124,28 +130,61 @@ class BaseJob(Base):
         will sleep 50 seconds to complete the 60 seconds and keep a steady
         heart rate. If you go over 60 seconds before calling it, it won't
         sleep at all.
-        '''
-        session = settings.Session()
-        job = session.query(BaseJob).filter(BaseJob.id == self.id).first()
 
-        if job.state == State.SHUTDOWN:
-            self.kill()
-
-        if job.latest_heartbeat:
+        The heartbeat itself is a single ``UPDATE`` statement, see
+        ``record_heartbeat``.
+        '''
+        if self.latest_heartbeat:
             sleep_for = self.heartrate - (
-                datetime.now() - job.latest_heartbeat).total_seconds()
+                datetime.now() - self.latest_heartbeat).total_seconds()
             if sleep_for > 0:
-                sleep(sleep_for)
-
-        job.latest_heartbeat = datetime.now()
+                self.heartbeat_wait(sleep_for)
 
-        session.merge(job)
-        session.commit()
-        session.close()
+        latest_heartbeat = datetime.now()
+        if self.record_heartbeat(latest_heartbeat):
+            self.kill()
+        self.latest_heartbeat = latest_heartbeat
 
         self.heartbeat_callback()
         logging.debug('[heart] Boom.')
 
+    def record_heartbeat(self, latest_heartbeat):
+        '''
+        Sets the job's latest_heartbeat and returns whether the job was
+        asked to shut down.
+
+        On backends supporting ``UPDATE ... RETURNING`` this is a single
+        statement. Elsewhere a job in the SHUTDOWN state is left out of the
+        ``UPDATE``, and its state is only looked up if it didn't match.
+
+        :param latest_heartbeat: the time of the heartbeat
+        :type latest_heartbeat: datetime
+        '''
+        job = BaseJob.__table__
+        with settings.engine.begin() as conn:
+            if getattr(conn.dialect, 'implicit_returning', False):
+                state = conn.execute(
+                    job.update()
+                    .where(job.c.id == self.id)
+                    .values(latest_heartbeat=latest_heartbeat)
+                    .returning(job.c.state)).scalar()
+                return state == State.SHUTDOWN
+
+            result = conn.execute(
+                job.update()
+                .where(job.c.id == self.id)
+                .where(or_(
+                    job.c.state == None,
+                    job.c.state != State.SHUTDOWN))
+                .values(latest_heartbeat=latest_heartbeat))
+            if result.rowcount:
+                return False
+            state = conn.execute(
+                job.select()
+                .with_only_columns([job.c.state])
+                .where(job.c.id == self.id)).scalar()
+            return state == State.SHUTDOWN
+
     def run(self):
         if statsd:
             statsd.incr(self.__class__.__name__.lower()+'_start', 1, 1)
@@ -175,6 +214,491 @@ class BaseJob(Base):
         raise NotImplemented("This method needs to be overriden")
 
 
+class DagLock(object):
+    """
+    Claims a DAG for the duration of a scheduling pass so that concurrent
+    schedulers, or scheduler processes, never process the same DAG at the
+    same time.
+
+    On backends that support it (PostgreSQL 9.5+, MySQL 8+, MariaDB 10.6+),
+    the ``dag`` row is locked with ``SELECT ... FOR UPDATE SKIP LOCKED`` in
+    a transaction that is held until ``release`` is called. Elsewhere
+    (SQLite, older versions), the lock is a lease taken with a
+    compare-and-set ``UPDATE``
+    on ``scheduler_lock`` and ``last_scheduler_run``, which expires after
+    ``lease`` in case the scheduler holding it dies.
+
+    :param dag_id: the id of the DAG to claim
+    :type dag_id: string
+    :param min_interval: the DAG isn't claimed if it was scheduled more
+        recently than this
+    :type min_interval: timedelta
+    :param lease: how long a lease based lock is honored
+    :type lease: timedelta
+    """
+    def __init__(
+            self, dag_id,
+            min_interval=timedelta(0),
+            lease=timedelta(minutes=5)):
+        self.dag_id = dag_id
+        self.min_interval = min_interval
+        self.lease = lease
+        self.conn = None
+        self.trans = None
+        self.leased = False
+
+    @staticmethod
+    def supports_skip_locked(dialect):
+        version = dialect.server_version_info or ()
+        if dialect.name == 'postgresql':
+            return version >= (9, 5)
+        elif dialect.name == 'mysql':
+            if 'MariaDB' in version:
+                # MariaDB only has SKIP LOCKED from 10.6, and may report
+                # its version behind a 5.5.5- prefix
+                numbers = [v for v in version if isinstance(v, int)]
+                if numbers[:3] == [5, 5, 5] and len(numbers) > 3:
+                    numbers = numbers[3:]
+                return tuple(numbers) >= (10, 6)
+            return version >= (8, 0, 1)
+        return False
+
+    def acquire(self):
+        """
+        Returns whether the DAG was claimed
+        """
+        now = datetime.now()
+        dag = models.DagModel.__table__
+        self.conn = settings.engine.connect()
+        if self.supports_skip_locked(self.conn.dialect):
+            self.trans = self.conn.begin()
+            row = self.conn.execute(text(
+                "SELECT last_scheduler_run FROM dag "
+                "WHERE dag_id = :dag_id FOR UPDATE SKIP LOCKED",
+                typemap={'last_scheduler_run': DateTime}),
+                dag_id=self.dag_id).fetchone()
+            if not row or (row[0] and row[0] > now - self.min_interval):
+                self.release()
+                return False
+            self.conn.execute(
+                dag.update()
+                .where(dag.c.dag_id == self.dag_id)
+                .values(last_scheduler_run=now))
+            return True
+
+        result = self.conn.execute(
+            dag.update()
+            .where(dag.c.dag_id == self.dag_id)
+            .where(or_(
+                dag.c.last_scheduler_run == None,
+                dag.c.last_scheduler_run < now - self.min_interval))
+            .where(or_(
+                dag.c.scheduler_lock == None,
+                dag.c.scheduler_lock == False,
+                dag.c.last_scheduler_run < now - self.lease))
+            .values(scheduler_lock=True, last_scheduler_run=now))
+        self.leased = result.rowcount == 1
+        if not self.leased:
+            self.release()
+        return self.leased
+
+    def release(self):
+        if self.trans:
+            self.trans.commit()
+            self.trans = None
+        if self.leased:
+            dag = models.DagModel.__table__
+            self.conn.execute(
+                dag.update()
+                .where(dag.c.dag_id == self.dag_id)
+                .values(scheduler_lock=False))
+            self.leased = False
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+class SchedulerWakeup(object):
+    """
+    Waits for the scheduler's next heartbeat while watching for anything
+    that may let more task instances run, so that the scheduler can start
+    its next loop right away instead of sleeping through the heartbeat:
+
+    * task instances reaching a terminal state, which send a UDP datagram
+      to ``[scheduler] wakeup_host:wakeup_port``
+    * events showing up in the executor's buffer, which isn't synced
+      while waiting
+    * DAG files of the DagBag being modified, when ``[scheduler]
+      dag_folder_watch`` is on and the folder is watched with inotify.
+      Otherwise finding the changes means walking the folder, which the
+      scheduler already does once per loop
+
+    If the socket can't be bound, for instance because another scheduler
+    runs on the same host, the task instance notifications are ignored and
+    the other sources are still polled.
+
+    :param host: the address to listen on
+    :type host: string
+    :param port: the UDP port to listen on, 0 disables the socket
+    :type port: int
+    :param poll_interval: how often, in seconds, the executor's buffer
+        and the DAG folder's watcher are checked
+    :type poll_interval: float
+    """
+    def __init__(self, host, port, poll_interval=1):
+        self.poll_interval = poll_interval
+        self.sock = None
+        if port:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind((host, port))
+                sock.setblocking(0)
+                self.sock = sock
+            except socket.error as e:
+                logging.warning(
+                    "Can't listen for wakeups on {host}:{port}, "
+                    "{e}".format(**locals()))
+
+    def drain(self):
+        try:
+            while self.sock.recv(1024):
+                pass
+        except socket.error:
+            pass
+
+    def dag_files_changed(self, dagbag):
+        if dagbag.watcher and dagbag.watcher.inotify:
+            return dagbag.watcher.has_changes()
+        return False
+
+    def wait(self, seconds, executor=None, dagbag=None):
+        """
+        Waits for up to ``seconds`` and returns what cut the wait short,
+        ``task_instance``, ``executor`` or ``dag_file``, or None if the
+        wait went through
+        """
+        deadline = datetime.now() + timedelta(seconds=seconds)
+        while True:
+            remaining = (deadline - datetime.now()).total_seconds()
+            if remaining <= 0:
+                return None
+            timeout = min(self.poll_interval, remaining)
+            if self.sock:
+                readable, _, _ = select.select([self.sock], [], [], timeout)
+                if readable:
+                    self.drain()
+                    return 'task_instance'
+            else:
+                sleep(timeout)
+            # The executor syncs at the heartbeat's cadence, for some
+            # executors a sync queries a remote backend
+            if executor and executor.event_buffer:
+                return 'executor'
+            if dagbag and self.dag_files_changed(dagbag):
+                return 'dag_file'
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class ShardRing(object):
+    """
+    Consistent hash ring assigning keys (dag_ids, file paths) to the members
+    of a group of schedulers. When a member joins or leaves, only the keys
+    of its neighbours on the ring move.
+
+    :param members: the ids of the members, shard numbers or job ids
+    :type members: list
+    :param replicas: number of points each member gets on the ring
+    :type replicas: int
+    """
+    def __init__(self, members, replicas=64):
+        self.members = sorted(members)
+        points = sorted([
+            (self.hash('{}:{}'.format(member, i)), member)
+            for member in self.members
+            for i in range(replicas)])
+        self.hashes = [h for h, _ in points]
+        self.nodes = [member for _, member in points]
+
+    @staticmethod
+    def hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get(self, key):
+        """
+        Returns the member owning the key
+        """
+        i = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.nodes[i]
+
+
+class QueuedKeysCollector(object):
+    """
+    Stands in for the executor in the scheduler's worker processes and
+    collects the keys of the task instances that should get queued, for
+    the parent process to send to the actual executor.
+    """
+    def __init__(self):
+        self.keys = []
+
+    def queue_task_instance(self, task_instance, *args, **kwargs):
+        self.keys.append(task_instance.key)
+
+
+# Set by the scheduler before its worker processes get forked
+_worker_context = {}
+
+
+def _init_dag_worker():
+    # Connections can't be shared with the parent process
+    settings.Session.remove()
+    settings.engine.dispose()
+    # The parent watches the folder, filters the files and syncs the dag
+    # table, the worker only reloads the files of the DAGs it gets sent
+    dagbag = _worker_context['dagbag']
+    dagbag.watcher = None
+    dagbag.sync_to_db = False
+    dagbag.file_filter = None
+    dagbag.parse_processes = 1
+    _worker_context['loaded'] = {}
+
+
+def _process_dag_in_worker(args):
+    """
+    Runs ``process_dag`` in a worker of the scheduler's pool. The worker
+    lives across scheduler loops, so it gets sent what it can't have
+    inherited: when the parent loaded the DAG, so that the worker reloads
+    its file when it changed, the state index entries of the DAG, the
+    pool slots and when the DAGs were last processed.
+    """
+    (dag_id, filepath, last_loaded, rows, slot_ledger,
+     dags_processed_at) = args
+    job = _worker_context['job']
+    dagbag = _worker_context['dagbag']
+    loaded = _worker_context['loaded']
+    start = datetime.now()
+    statements = utils.sql_statement_count()
+    keys = []
+    invalid = False
+    try:
+        dag = dagbag.dags.get(dag_id)
+        if loaded.get(dag_id, dag and dag.last_loaded) != last_loaded:
+            dagbag.process_file(
+                filepath, only_if_updated=False, safe_mode=False)
+            loaded[dag_id] = last_loaded
+        job.state_index = TaskStateIndex.from_rows(rows)
+        job.slot_ledger = slot_ledger
+        job.dags_processed_at = dags_processed_at
+        collector = QueuedKeysCollector()
+        job.process_dag(dagbag.dags[dag_id], collector)
+        keys = collector.keys
+        invalid = dag_id in job.state_index.invalid_dag_ids
+    except Exception as e:
+        logging.exception(e)
+    settings.Session.remove()
+    duration = (datetime.now() - start).total_seconds()
+    statements = utils.sql_statement_count() - statements
+    return dag_id, keys, invalid, duration, statements
+
+
+class IndexedTaskInstance(namedtuple(
+        'IndexedTaskInstance',
+        ['dag_id', 'task_id', 'execution_date', 'state'])):
+    """
+    The fields of a task instance the TaskStateIndex relies on, light
+    enough to be sent to the scheduler's worker processes
+    """
+    @property
+    def key(self):
+        return (self.dag_id, self.task_id, self.execution_date)
+
+
+class TaskStateIndex(object):
+    """
+    In-process index of the task instances the scheduler cares about, keyed
+    by ``(dag_id, task_id, execution_date)``. It holds the latest task
+    instance for each task as well as every task instance that isn't done
+    yet (queued, running or up for retry), and the list of paused DAGs.
+
+    After an initial full load, it is kept up to date from the rows whose
+    ``updated_at`` changed since the previous sync and from the keys
+    reported by the executor's event buffer, so that each scheduler loop
+    only reads deltas instead of scanning the ``task_instance`` table.
+    Deleted rows (cleared task instances) aren't visible to the delta
+    query, ``invalidate_dag`` forces a reload for a DAG and ``full_sync``
+    should be called periodically.
+
+    :param lookback: how far before the previous sync to look for changed
+        rows, this absorbs clock skew across the hosts writing to the
+        database and transactions committed while syncing
+    :type lookback: timedelta
+    """
+    active_states = (State.QUEUED, State.RUNNING, State.UP_FOR_RETRY)
+
+    def __init__(self, lookback=timedelta(seconds=60)):
+        self.lookback = lookback
+        self.latest = defaultdict(dict)
+        self.active = {}
+        self.paused_dag_ids = set()
+        self.last_sync = None
+        self.invalid_dag_ids = set()
+
+    def update(self, ti):
+        """
+        Folds a task instance row into the index
+        """
+        if ti.state in self.active_states:
+            self.active[ti.key] = ti
+        elif ti.key in self.active:
+            del self.active[ti.key]
+        latest = self.latest[ti.dag_id].get(ti.task_id)
+        if not latest or ti.execution_date >= latest.execution_date:
+            self.latest[ti.dag_id][ti.task_id] = ti
+
+    def _load_latest(self, session, dag_ids=None):
+        TI = models.TaskInstance
+        sq = session.query(
+            TI.dag_id,
+            TI.task_id,
+            func.max(TI.execution_date).label('max_ti')
+        )
+        if dag_ids:
+            sq = sq.filter(TI.dag_id.in_(dag_ids))
+        sq = sq.group_by(TI.dag_id, TI.task_id).subquery('sq')
+        return session.query(TI).filter(
+            TI.dag_id == sq.c.dag_id,
+            TI.task_id == sq.c.task_id,
+            TI.execution_date == sq.c.max_ti,
+        ).all()
+
+    def full_sync(self, session):
+        """
+        Rebuilds the index from scratch
+        """
+        TI = models.TaskInstance
+        sync_start = datetime.now()
+        self.latest = defaultdict(dict)
+        self.active = {}
+        self.invalid_dag_ids = set()
+        tis = self._load_latest(session)
+        tis += (
+            session.query(TI)
+            .filter(TI.state.in_(self.active_states))
+            .all()
+        )
+        self.load_paused_dag_ids(session)
+        session.expunge_all()
+        for ti in tis:
+            self.update(ti)
+        self.last_sync = sync_start
+        logging.info(
+            "Task state index loaded {} task instances".format(len(tis)))
+
+    def load_paused_dag_ids(self, session):
+        DagModel = models.DagModel
+        self.paused_dag_ids = {
+            dag_id for dag_id, in session.query(DagModel.dag_id).filter(
+                DagModel.is_paused == True)}
+
+    def sync(self, session, event_keys=None):
+        """
+        Applies the rows changed since the last sync, the task instances
+        reported by the executor and reloads the invalidated DAGs. The
+        paused DAGs are read again, so that pausing a DAG applies on the
+        next loop.
+
+        :param event_keys: task instance keys the executor reported on
+        :type event_keys: list of tuples
+        """
+        if self.last_sync is None:
+            return self.full_sync(session)
+        TI = models.TaskInstance
+        sync_start = datetime.now()
+        conditions = [TI.updated_at >= self.last_sync - self.lookback]
+        for dag_id, task_id, execution_date in event_keys or []:
+            conditions.append(and_(
+                TI.dag_id == dag_id,
+                TI.task_id == task_id,
+                TI.execution_date == execution_date))
+        tis = session.query(TI).filter(or_(*conditions)).all()
+        if self.invalid_dag_ids:
+            dag_ids = list(self.invalid_dag_ids)
+            for dag_id in dag_ids:
+                self.latest.pop(dag_id, None)
+            for key in list(self.active):
+                if key[0] in self.invalid_dag_ids:
+                    del self.active[key]
+            tis += self._load_latest(session, dag_ids)
+            tis += (
+                session.query(TI)
+                .filter(
+                    TI.dag_id.in_(dag_ids),
+                    TI.state.in_(self.active_states))
+                .all()
+            )
+            self.invalid_dag_ids = set()
+        self.load_paused_dag_ids(session)
+        session.expunge_all()
+        for ti in tis:
+            self.update(ti)
+        self.last_sync = sync_start
+        logging.debug("{} task instances changed".format(len(tis)))
+
+    def rows_for_dag(self, dag_id):
+        """
+        Returns the entries of the index for a DAG as IndexedTaskInstance
+        tuples, from which ``from_rows`` rebuilds an index
+        """
+        tis = list(self.latest_for_dag(dag_id).values()) + [
+            ti for key, ti in self.active.items() if key[0] == dag_id]
+        return [
+            IndexedTaskInstance(
+                ti.dag_id, ti.task_id, ti.execution_date, ti.state)
+            for ti in tis]
+
+    @classmethod
+    def from_rows(cls, rows):
+        index = cls()
+        for row in rows:
+            index.update(row)
+        return index
+
+    def invalidate_dag(self, dag_id):
+        """
+        Flags a DAG as needing to be reloaded from the database on the next
+        sync, for instance because some of its task instances were deleted
+        """
+        self.invalid_dag_ids.add(dag_id)
+
+    def latest_for_dag(self, dag_id):
+        """
+        Returns a dictionary of task_id to the latest task instance
+        """
+        return self.latest.get(dag_id, {})
+
+    def active_dates_for_dag(self, dag_id):
+        """
+        Returns the sorted execution dates for which the DAG has task
+        instances in one of the active states
+        """
+        return sorted(set([
+            execution_date
+            for key_dag_id, _, execution_date in self.active
+            if key_dag_id == dag_id]))
+
+    def queued(self):
+        """
+        Returns the list of task instances in the QUEUED state
+        """
+        return [
+            ti for ti in self.active.values() if ti.state == State.QUEUED]
+
+
 class SchedulerJob(BaseJob):
     """
     This SchedulerJob runs indefinetly and constantly schedules the jobs
@@ -193,6 +717,22 @@ class SchedulerJob(BaseJob):
     :param refresh_dags_every: force refresh the DAG definition every N
         runs, as specified here
     :type refresh_dags_every: int
+    :param dag_processes: number of processes used to schedule DAGs in
+        parallel, DAGs are processed serially in the scheduler's process
+        when set to 1
+    :type dag_processes: int
+    :param shard_index: with ``shard_count``, the slice of the DAGs this
+        scheduler is responsible for, between 0 and ``shard_count - 1``
+    :type shard_index: int
+    :param shard_count: the number of schedulers the DAGs are split across
+    :type shard_count: int
+    :param dynamic_shards: split the DAGs across all the schedulers that
+        are alive according to the ``job`` table. The DAGs of a scheduler
+        that stops heartbeating get picked up by the others
+    :type dynamic_shards: bool
+    :param num_runs: stop after this many scheduler loops, runs
+        indefinitely when not set
+    :type num_runs: int
     """
 
     __mapper_args__ = {
@@ -205,140 +745,316 @@ class SchedulerJob(BaseJob):
             subdir=None,
             test_mode=False,
             refresh_dags_every=10,
+            dag_processes=conf.getint('scheduler', 'DAG_PROCESSES'),
+            shard_index=None,
+            shard_count=None,
+            dynamic_shards=False,
+            num_runs=None,
             *args, **kwargs):
         self.dag_id = dag_id
+        self.num_runs = num_runs
         self.subdir = subdir
         self.test_mode = test_mode
         self.refresh_dags_every = refresh_dags_every
+        self.dag_processes = dag_processes
+        self.slot_ledger = None
+        self.dag_pool = None
+        self.wakeup = None
+        self.wakeup_sources = {}
+        self.dags_processed_at = None
+        if shard_count and not (
+                shard_index is not None and 0 <= shard_index < shard_count):
+            raise Exception(
+                "shard_index should be between 0 and {}".format(
+                    shard_count - 1))
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.dynamic_shards = dynamic_shards
+        self.shard_ring = None
+        self.owned_files = set()
+        self.known_files = set()
+        self.store_serialized_dags = conf.getboolean(
+            'core', 'STORE_SERIALIZED_DAGS')
+        self.serialized_at = {}
         super(SchedulerJob, self).__init__(*args, **kwargs)
 
         self.heartrate = conf.getint('scheduler', 'SCHEDULER_HEARTBEAT_SEC')
+        self.state_index = TaskStateIndex(
+            lookback=timedelta(seconds=self.heartrate))
+        self.loop_stats = {}
 
     def process_dag(self, dag, executor):
         """
-        This moethod schedules a single DAG by looking at the latest
-        run for eachtask and attempting to schedule the following run.
+        This method schedules a single DAG. It looks at the execution
+        dates that are in flight and at the schedules following the latest
+        run of each task, and queues every task instance whose dependencies
+        are met, in date order, as long as fewer than the DAG's
+        ``max_active_runs`` dates are in flight.
 
         As multiple schedulers may be running for redundancy, this
-        function takes a lock on the DAG and timestamps the last run
-        in ``last_scheduler_run``.
+        function claims the DAG with a ``DagLock`` and skips it if another
+        scheduler holds it or scheduled it since this scheduler's previous
+        loop, or less than a heartbeat ago for a scheduler that just
+        started.
         """
-        DagModel = models.DagModel
-        session = settings.Session()
-
-        db_dag = session.query(
-            DagModel).filter(DagModel.dag_id == dag.dag_id).first()
-        last_scheduler_run = db_dag.last_scheduler_run or datetime(2000, 1, 1)
-        secs_since_last = (
-            datetime.now() - last_scheduler_run).total_seconds()
-        # if db_dag.scheduler_lock or
-        if secs_since_last < self.heartrate:
-            session.commit()
-            session.close()
+        min_interval = timedelta(seconds=self.heartrate)
+        if self.dags_processed_at:
+            min_interval = min(
+                min_interval, datetime.now() - self.dags_processed_at)
+        lock = DagLock(
+            dag.dag_id,
+            min_interval=min_interval,
+            lease=timedelta(seconds=self.heartrate * 5))
+        if not lock.acquire():
+            logging.debug("Skipping {}, claimed recently".format(dag.dag_id))
             return None
-        else:
-            # Taking a lock
-            db_dag.scheduler_lock = True
-            db_dag.last_scheduler_run = datetime.now()
-            session.commit()
+        try:
+            self._process_dag(dag, executor)
+        finally:
+            lock.release()
 
+    def _process_dag(self, dag, executor):
         TI = models.TaskInstance
-        logging.info(
-            "Getting latest instance "
-            "for all task in dag " + dag.dag_id)
-        sq = session.query(
-            TI.task_id,
-            func.max(TI.execution_date).label('max_ti')
-        ).filter(
-            TI.dag_id == dag.dag_id
-        ).group_by(TI.task_id).subquery('sq')
-
-        qry = session.query(TI).filter(
-            TI.dag_id == dag.dag_id,
-            TI.task_id == sq.c.task_id,
-            TI.execution_date == sq.c.max_ti,
-        )
-        logging.debug("Querying max dates for each task")
-        latest_ti = qry.all()
-        ti_dict = {ti.task_id: ti for ti in latest_ti}
+        ti_dict = self.state_index.latest_for_dag(dag.dag_id)
+        tasks = [t for t in dag.tasks if not t.adhoc]
+        if not tasks:
+            return
+
+        # Each task moves forward from its own latest schedule, so that a
+        # task that failed or is blocked doesn't hold back the others. The
+        # execution dates already in flight are looked at for every task,
+        # and a new date only counts against max_active_runs once a task
+        # instance gets queued for it
+        in_flight = set(self.state_index.active_dates_for_dag(dag.dag_id))
+        cutoff = datetime.now() - dag.schedule_interval
+        task_dates = {}
+        for task in tasks:
+            if task.task_id in ti_dict:
+                next_schedule = (
+                    ti_dict[task.task_id].execution_date +
+                    dag.schedule_interval)
+            else:
+                next_schedule = task.start_date
+            schedules = []
+            while (
+                    len(schedules) < dag.max_active_runs and
+                    next_schedule <= cutoff):
+                if next_schedule not in in_flight:
+                    schedules.append(next_schedule)
+                next_schedule += dag.schedule_interval
+            task_dates[task.task_id] = sorted(in_flight.union(schedules))
+
+        # Loading everything needed to evaluate the dependencies of the
+        # window in one query, the previous schedule is included for
+        # depends_on_past and wait_for_downstream
+        dates = set()
+        for execution_dates in task_dates.values():
+            for execution_date in execution_dates:
+                dates.add(execution_date)
+                dates.add(execution_date - dag.schedule_interval)
+        for ti in ti_dict.values():
+            dates.add(ti.execution_date)
+        session = settings.Session()
+        ti_states = TI.get_dag_ti_states(dag.dag_id, dates, session)
+        slot_ledger = self.slot_ledger or models.PoolSlotLedger(session)
         session.expunge_all()
         session.commit()
-        logging.debug("{} rows returned".format(len(latest_ti)))
 
-        for task in dag.tasks:
-            if task.adhoc:
+        for latest in ti_dict.values():
+            if latest.key[1:] not in ti_states:
+                # Some task instances got cleared since the index last saw
+                # them, the window can't be trusted until it's reloaded
+                self.state_index.invalidate_dag(dag.dag_id)
+                session.close()
+                return
+
+        candidates = []
+        for task in tasks:
+            for execution_date in task_dates[task.task_id]:
+                if execution_date < task.start_date:
+                    continue
+                if task.end_date and execution_date > task.end_date:
+                    continue
+                ti = ti_states.get((task.task_id, execution_date))
+                if not ti:
+                    # Brand new task instance, let's get started
+                    candidates.append((TI(task, execution_date), True))
+                elif ti.state in (State.UP_FOR_RETRY, State.QUEUED):
+                    candidates.append((ti, True))
+                elif ti.state is None:
+                    candidates.append((ti, False))
+        candidates.sort(key=lambda c: c[0].execution_date)
+
+        for ti, check_pool in candidates:
+            if (
+                    ti.execution_date not in in_flight and
+                    len(in_flight) >= dag.max_active_runs):
                 continue
-            if task.task_id not in ti_dict:
-                # Brand new task, let's get started
-                ti = TI(task, task.start_date)
-                ti.refresh_from_db()
-                if ti.is_runnable():
-                    logging.info(
-                        'First run for {ti}'.format(**locals()))
-                    executor.queue_task_instance(ti)
+            task = dag.get_task(ti.task_id)
+            ti.task = task  # Hacky but worky
+            if check_pool:
+                runnable = ti.is_runnable(
+                    ti_states=ti_states, slot_ledger=slot_ledger)
             else:
-                ti = ti_dict[task.task_id]
-                ti.task = task  # Hacky but worky
-                if ti.state == State.RUNNING:
-                    continue  # Only one task at a time
-                elif ti.state == State.UP_FOR_RETRY:
-                    # If task instance if up for retry, make sure
-                    # the retry delay is met
-                    if ti.is_runnable():
-                        logging.debug('Triggering retry: ' + str(ti))
-                        executor.queue_task_instance(ti)
-                elif ti.state == State.QUEUED:
-                    # If task instance if up for retry, make sure
-                    if ti.is_runnable():
+                runnable = ti.is_queueable(ti_states=ti_states)
+            if runnable:
+                if check_pool and task.pool:
+                    slot_ledger.take(task.pool)
+                logging.debug('Queuing: ' + str(ti))
+                executor.queue_task_instance(ti)
+                in_flight.add(ti.execution_date)
+        session.close()
+
+    def process_dags_in_pool(self, dags, dagbag, executor):
+        """
+        Fans ``process_dag`` out over a pool of ``dag_processes`` forked
+        processes, created on the first call and kept until the scheduler
+        exits. The workers report the task instances to queue and the
+        parent sends them to the executor. Each worker only accounts for
+        the pool slots it hands out itself, so the parent checks every task
+        instance against its own ``PoolSlotLedger`` before queuing it, the
+        ones whose pool is full wait for a later loop.
+        """
+        # Kept current for the workers the pool replaces
+        _worker_context['job'] = self
+        _worker_context['dagbag'] = dagbag
+        if self.dag_pool is None:
+            self.dag_pool = multiprocessing.Pool(
+                self.dag_processes, initializer=_init_dag_worker)
+        results = self.dag_pool.map(_process_dag_in_worker, [
+            (
+                dag.dag_id, dag.full_filepath, dag.last_loaded,
+                self.state_index.rows_for_dag(dag.dag_id), self.slot_ledger,
+                self.dags_processed_at)
+            for dag in dags])
+
+        TI = models.TaskInstance
+        if self.slot_ledger is None:
+            session = settings.Session()
+            self.slot_ledger = models.PoolSlotLedger(session)
+            session.close()
+        for dag_id, keys, invalid, duration, statements in results:
+            self.record_phase('process_dag.' + dag_id, duration, statements)
+            if invalid:
+                self.state_index.invalidate_dag(dag_id)
+            dag = dagbag.dags[dag_id]
+            for _, task_id, execution_date in keys:
+                task = dag.get_task(task_id)
+                if task.pool and task.pool in self.slot_ledger:
+                    if self.slot_ledger.open_slots(task.pool) <= 0:
                         logging.debug(
-                            'Starting previously queued : ' + str(ti))
-                        executor.queue_task_instance(ti)
-                else:
-                    # Trying to run the next schedule
-                    next_schedule = (
-                        ti.execution_date + task.schedule_interval)
-                    if (
-                            ti.task.end_date and
-                            next_schedule > ti.task.end_date):
+                            "Pool {} is full, not queuing {} {} {}".format(
+                                task.pool, dag_id, task_id, execution_date))
                         continue
-                    ti = TI(
-                        task=task,
-                        execution_date=next_schedule,
-                    )
-                    ti.refresh_from_db()
-                    if ti.is_queueable():
-                        logging.debug('Queuing next run: ' + str(ti))
-                        executor.queue_task_instance(ti)
-        # Releasing the lock
-        logging.debug("Unlocking DAG (scheduler_lock)")
-        db_dag = (
-            session.query(DagModel)
-            .filter(DagModel.dag_id == dag.dag_id)
-            .first()
-        )
-        db_dag.scheduler_lock = False
-        session.merge(db_dag)
+                    self.slot_ledger.take(task.pool)
+                ti = TI(task, execution_date)
+                logging.debug('Queuing: ' + str(ti))
+                executor.queue_task_instance(ti)
+
+    def close_dag_pool(self):
+        if self.dag_pool is not None:
+            self.dag_pool.close()
+            self.dag_pool.join()
+            self.dag_pool = None
+        _worker_context.clear()
+
+    @property
+    def sharded(self):
+        return bool(self.shard_count) or self.dynamic_shards
+
+    def refresh_shard(self, session):
+        """
+        Updates the ring of schedulers sharing the DAGs and the set of DAG
+        files this scheduler should parse. With dynamic shards, the members
+        are the SchedulerJobs that heartbeat within 5 heartbeats.
+        """
+        if self.dynamic_shards:
+            limit = datetime.now() - timedelta(seconds=self.heartrate * 5)
+            members = set([
+                job_id for job_id, in session.query(SchedulerJob.id).filter(
+                    SchedulerJob.state == State.RUNNING,
+                    SchedulerJob.latest_heartbeat > limit)])
+            members.add(self.id)
+        else:
+            members = range(self.shard_count)
+        if not self.shard_ring or self.shard_ring.members != sorted(members):
+            logging.info("Scheduler shards: {}".format(sorted(members)))
+            self.shard_ring = ShardRing(members)
+
+        DM = models.DagModel
+        dag_files = session.query(DM.dag_id, DM.fileloc).filter(
+            DM.is_subdag == False).all()
+        self.known_files = set([fileloc for _, fileloc in dag_files])
+        self.owned_files = set([
+            fileloc for dag_id, fileloc in dag_files
+            if self.owns_dag(dag_id)])
+
+    def shard_member(self):
+        if self.dynamic_shards:
+            return self.id
+        return self.shard_index
+
+    def owns_dag(self, dag_id):
+        if not self.sharded:
+            return True
+        return self.shard_ring.get(dag_id) == self.shard_member()
+
+    def owns_file(self, filepath):
+        """
+        Whether this scheduler should parse a DAG file: files defining DAGs
+        it owns, and files that no DAG is known for yet when they hash to
+        this scheduler
+        """
+        if not self.sharded or filepath in self.owned_files:
+            return True
+        if filepath in self.known_files:
+            return False
+        return self.shard_ring.get(filepath) == self.shard_member()
+
+    def get_dagbag(self):
+        return models.DagBag(
+            self.subdir, executor=self.executor, sync_to_db=True,
+            file_filter=self.owns_file if self.sharded else None,
+            watch=conf.getboolean('scheduler', 'DAG_FOLDER_WATCH'))
+
+    def serialize_dags(self, dagbag):
+        """
+        Stores the DAGs of the DagBag reloaded since the last call in the
+        ``serialized_dag`` table the webserver reads from
+        """
+        dags = []
+        for dag in dagbag.dags.values():
+            root_dag = dag
+            while root_dag.parent_dag:
+                root_dag = root_dag.parent_dag
+            if (
+                    self.serialized_at.get(dag.dag_id) != dag.last_loaded and
+                    self.owns_dag(root_dag.dag_id)):
+                dags.append(dag)
+        if not dags:
+            return
+        session = settings.Session()
+        written = models.SerializedDag.write_dags(dags, session)
         session.commit()
-
         session.close()
+        for dag in dags:
+            self.serialized_at[dag.dag_id] = dag.last_loaded
+        logging.info("Stored the serialization of {} DAGs".format(written))
 
     @utils.provide_session
     def prioritize_queued(self, session, executor, dagbag):
         # Prioritizing queued task instances
+        self.slot_ledger = models.PoolSlotLedger(session)
 
-        pools = {p.pool: p for p in session.query(models.Pool).all()}
-        TI = models.TaskInstance
-        queued_tis = (
-            session.query(TI)
-            .filter(TI.state == State.QUEUED)
-            .all()
-        )
         d = defaultdict(list)
-        for ti in queued_tis:
-            d[ti.pool].append(ti)
+        for ti in self.state_index.queued():
+            if self.owns_dag(ti.dag_id):
+                d[ti.pool].append(ti)
 
         for pool, tis in d.items():
-            open_slots = pools[ti.pool].open_slots(session=session)
+            if pool not in self.slot_ledger:
+                continue
+            open_slots = self.slot_ledger.open_slots(pool)
             if open_slots > 0:
                 tis = sorted(
                     tis, key=lambda ti: ti.priority_weight, reverse=True)
@@ -351,6 +1067,7 @@ class SchedulerJob(BaseJob):
                     if task:
                         ti.task = task
                         executor.queue_task_instance(ti)
+                        self.slot_ledger.take(pool)
 
 
     def _execute(self):
@@ -358,6 +1075,8 @@ class SchedulerJob(BaseJob):
 
         def signal_handler(signum, frame):
             logging.error("SIGINT (ctrl-c) received")
+            if self.dag_pool is not None:
+                self.dag_pool.terminate()
             sys.exit(1)
         signal.signal(signal.SIGINT, signal_handler)
 
@@ -366,54 +1085,177 @@ class SchedulerJob(BaseJob):
         logging.basicConfig(level=logging.DEBUG)
         logging.info("Starting the scheduler")
 
-        dagbag = models.DagBag(self.subdir, sync_to_db=True)
+        if self.sharded:
+            session = settings.Session()
+            self.refresh_shard(session)
+            session.close()
+        dagbag = self.get_dagbag()
         executor = dagbag.executor
         executor.start()
+        self.wakeup = SchedulerWakeup(
+            host=conf.get('scheduler', 'wakeup_host'),
+            port=conf.getint('scheduler', 'wakeup_port'))
         i = 0
-        while (not self.test_mode) or i < 1:
-            try:
-                self.prioritize_queued(executor=executor, dagbag=dagbag)
-            except Exception as e:
-                logging.exception(e)
+        num_runs = 1 if self.test_mode else self.num_runs
+        while not num_runs or i < num_runs:
+            self.loop_stats = {}
+            loop_start = datetime.now()
+            loop_statements = utils.sql_statement_count()
+            queued_before = set(executor.queued_tasks)
+
+            with self.timed('state_index_sync'):
+                session = settings.Session()
+                try:
+                    if self.sharded:
+                        self.refresh_shard(session)
+                    if i % self.refresh_dags_every == 0:
+                        self.state_index.full_sync(session)
+                    else:
+                        event_keys = executor.get_event_buffer().keys()
+                        self.state_index.sync(session, event_keys)
+                except Exception as e:
+                    logging.exception(e)
+                session.commit()
+                session.close()
+
+            with self.timed('prioritize_queued'):
+                try:
+                    self.prioritize_queued(executor=executor, dagbag=dagbag)
+                except Exception as e:
+                    logging.exception(e)
 
             i += 1
-            try:
-                if i % self.refresh_dags_every == 0:
-                    dagbag = models.DagBag(self.subdir, sync_to_db=True)
-                else:
-                    dagbag.collect_dags(only_if_updated=True)
-            except:
-                logging.error("Failed at reloading the dagbag")
-                if statsd:
-                    statsd.incr('dag_refresh_error', 1, 1)
-                sleep(5)
+            with self.timed('dagbag_refresh'):
+                try:
+                    if i % self.refresh_dags_every == 0:
+                        dagbag = self.get_dagbag()
+                    else:
+                        dagbag.collect_dags(
+                            dagbag.dag_folder, only_if_updated=True)
+                except:
+                    logging.error("Failed at reloading the dagbag")
+                    if statsd:
+                        statsd.incr('dag_refresh_error', 1, 1)
+                    sleep(5)
+
+            if self.store_serialized_dags:
+                with self.timed('serialize_dags'):
+                    try:
+                        self.serialize_dags(dagbag)
+                    except Exception as e:
+                        logging.exception(e)
 
             if dag_id:
                 dags = [dagbag.dags[dag_id]]
             else:
                 dags = [
                     dag for dag in dagbag.dags.values() if not dag.parent_dag]
-            paused_dag_ids = dagbag.paused_dags()
-            for dag in dags:
-                logging.debug("Scheduling {}".format(dag.dag_id))
-                dag = dagbag.get_dag(dag.dag_id)
-                if not dag or (dag.dag_id in paused_dag_ids):
-                    continue
+            paused_dag_ids = self.state_index.paused_dag_ids
+            # One read of the expiry dates for all the DAGs of the loop
+            dagbag.expire_snapshot()
+            dags = [dagbag.get_dag(dag.dag_id) for dag in dags]
+            dags = [
+                dag for dag in dags
+                if dag and dag.dag_id not in paused_dag_ids and
+                self.owns_dag(dag.dag_id)]
+            if self.dag_processes > 1 and len(dags) > 1:
+                with self.timed('process_dags'):
+                    try:
+                        self.process_dags_in_pool(dags, dagbag, executor)
+                    except Exception as e:
+                        logging.exception(e)
+            else:
+                for dag in dags:
+                    logging.debug("Scheduling {}".format(dag.dag_id))
+                    with self.timed('process_dag.' + dag.dag_id):
+                        try:
+                            self.process_dag(dag, executor)
+                        except Exception as e:
+                            logging.exception(e)
+            self.dags_processed_at = datetime.now()
+            queued = len(set(executor.queued_tasks) - queued_before)
+            logging.debug(
+                "Done qeuing tasks, calling the executor's heartbeat")
+            with self.timed('executor_heartbeat'):
                 try:
-                    self.process_dag(dag, executor)
+                    # We really just want the scheduler to never ever stop.
+                    executor.heartbeat()
                 except Exception as e:
                     logging.exception(e)
-            logging.debug(
-                "Done qeuing tasks, calling the executor's heartbeat")
+                    logging.error("Tachycardia!")
+            self.report_loop(loop_start, loop_statements, queued)
+            self.wakeup_sources = {'executor': executor, 'dagbag': dagbag}
             try:
-                # We really just want the scheduler to never ever stop.
-                executor.heartbeat()
                 self.heartbeat()
             except Exception as e:
                 logging.exception(e)
                 logging.error("Tachycardia!")
+        self.close_dag_pool()
+        self.wakeup.close()
         executor.end()
 
+    def heartbeat_wait(self, seconds):
+        if not self.wakeup:
+            return super(SchedulerJob, self).heartbeat_wait(seconds)
+        reason = self.wakeup.wait(seconds, **self.wakeup_sources)
+        if reason:
+            logging.debug("Woken up early by: {}".format(reason))
+            if statsd:
+                statsd.incr('scheduler.wakeup.' + reason, 1, 1)
+
+    @contextmanager
+    def timed(self, phase):
+        """
+        Measures the duration and the number of SQL statements issued by a
+        phase of the scheduler loop. The measures are kept in
+        ``loop_stats`` and sent to statsd as ``scheduler.<phase>`` timers
+        and ``scheduler.<phase>.statements`` gauges.
+        """
+        start = datetime.now()
+        statements = utils.sql_statement_count()
+        try:
+            yield
+        finally:
+            self.record_phase(
+                phase,
+                (datetime.now() - start).total_seconds(),
+                utils.sql_statement_count() - statements)
+
+    def record_phase(self, phase, duration, statements):
+        self.loop_stats[phase] = (duration, statements)
+        logging.debug(
+            "Phase {phase} took {duration:.3f}s and "
+            "{statements} SQL statements".format(**locals()))
+        if statsd:
+            statsd.timing('scheduler.' + phase, duration * 1000)
+            statsd.gauge('scheduler.' + phase + '.statements', statements)
+
+    def report_loop(self, loop_start, loop_statements, queued):
+        """
+        Logs and sends to statsd the totals for a scheduler loop, and logs
+        the DAGs that took the longest to process.
+        """
+        duration = (datetime.now() - loop_start).total_seconds()
+        statements = utils.sql_statement_count() - loop_statements
+        logging.info(
+            "Scheduler loop took {duration:.3f}s, issued {statements} SQL "
+            "statements and queued {queued} task instances".format(
+                **locals()))
+        slowest = sorted(
+            [
+                (v[0], k[len('process_dag.'):])
+                for k, v in self.loop_stats.items()
+                if k.startswith('process_dag.')],
+            reverse=True)[:5]
+        for dag_duration, dag_id in slowest:
+            logging.info(
+                "DAG {dag_id} took {dag_duration:.3f}s to process".format(
+                    **locals()))
+        if statsd:
+            statsd.timing('scheduler.loop', duration * 1000)
+            statsd.gauge('scheduler.loop.statements', statements)
+            statsd.gauge('scheduler.queued_tis', queued)
+
     def heartbeat_callback(self):
         if statsd:
             statsd.gauge('scheduler_heartbeat', 1, 1)
@@ -499,12 +1341,16 @@ class BackfillJob(BaseJob):
                 len(wont_run))
 
             logging.info(msg)
+            verdicts = models.TaskInstance.check_readiness(
+                tasks_to_run.values())
             for key, ti in tasks_to_run.items():
-                ti.refresh_from_db()
+                ready, reason = verdicts[key]
                 if ti.state == State.SUCCESS and key in tasks_to_run:
                     succeeded.append(key)
                     del tasks_to_run[key]
-                elif ti.is_runnable():
+                elif not ready:
+                    logging.debug("Not running {}: {}".format(ti, reason))
+                else:
                     executor.queue_task_instance(
                         ti,
                         mark_success=self.mark_success,
@@ -573,11 +1419,80 @@ class LocalTaskJob(BaseJob):
             mark_success=self.mark_success,
             job_id=self.id,
         )
+        rusage_before = utils.children_rusage()
         self.process = subprocess.Popen(['bash', '-c', command])
-        return_code = None
-        while return_code is None:
-            self.heartbeat()
-            return_code = self.process.poll()
+        sampler = utils.ProcessTreeSampler(self.process.pid)
+
+        # Heartbeating and sampling from threads so that the process gets
+        # reaped as soon as it exits
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_error = None
+        threads = [threading.Thread(target=self.heartbeat_loop)]
+        interval = conf.getfloat('core', 'TASK_RESOURCE_SAMPLE_INTERVAL')
+        if interval > 0:
+            threads.append(threading.Thread(
+                target=self.sample_loop, args=(sampler, interval)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            self.process.wait()
+        finally:
+            self.heartbeat_stop.set()
+            for thread in threads:
+                thread.join()
+        self.record_resource_usage(sampler, rusage_before)
+        if self.heartbeat_error:
+            raise self.heartbeat_error
+
+    def sample_loop(self, sampler, interval):
+        while not self.heartbeat_stop.is_set():
+            try:
+                sampler.sample()
+            except Exception as e:
+                logging.exception(e)
+                return
+            self.heartbeat_stop.wait(interval)
+
+    def record_resource_usage(self, sampler, rusage_before):
+        """
+        Stores the resources the task instance's process tree used on the
+        task instance, if this job ran it. The CPU times and context
+        switches of the processes that were waited for are exact, the
+        rest is as sampled.
+        """
+        usage = sampler.usage()
+        rusage = utils.children_rusage()
+        for k in ('cpu_user_time', 'cpu_system_time', 'context_switches'):
+            usage[k] = max(usage[k], rusage[k] - rusage_before[k])
+        usage['max_rss_kb'] = max(usage['max_rss_kb'], rusage['max_rss_kb'])
+
+        ti = self.task_instance
+        TI = models.TaskInstance
+        session = settings.Session()
+        session.query(TI).filter(
+            TI.dag_id == ti.dag_id,
+            TI.task_id == ti.task_id,
+            TI.execution_date == ti.execution_date,
+            TI.job_id == self.id,
+        ).update(usage, synchronize_session=False)
+        session.commit()
+        session.close()
+        logging.info("Resource usage: {}".format(usage))
+
+    def heartbeat_loop(self):
+        while not self.heartbeat_stop.is_set():
+            try:
+                self.heartbeat()
+            except Exception as e:
+                # Includes the exception raised by kill(), which already
+                # terminated the process
+                logging.exception(e)
+                self.heartbeat_error = e
+                return
+
+    def heartbeat_wait(self, seconds):
+        self.heartbeat_stop.wait(seconds)
 
     def on_kill(self):
         self.process.terminate()
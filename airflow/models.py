@@ -1,22 +1,38 @@
+import ast
+import atexit
+from collections import defaultdict
 import copy
+import ctypes
+import ctypes.util
 from datetime import datetime, timedelta
+import dateutil.parser
+import errno
 import getpass
+import hashlib
 import imp
 import jinja2
+import json
 import logging
+import multiprocessing
 import os
 import dill
 import re
+import resource
 import signal
 import socket
+import struct
 import sys
+import threading
+import time
+import traceback
 
 from sqlalchemy import (
     Column, Integer, String, DateTime, Text, Boolean, ForeignKey, PickleType,
-    Index,)
-from sqlalchemy import func, or_
+    Index, Float, BigInteger)
+from sqlalchemy import and_, case, func, or_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 
 from airflow.executors import DEFAULT_EXECUTOR, LocalExecutor
@@ -37,6 +53,487 @@ else:
     LongText = Text
 
 
+def _import_dag_file(filepath, import_timeout=0):
+    '''
+    Imports a DAG file, giving up after ``import_timeout`` seconds. Returns
+    the module (None if the import failed), the DAGs found, the traceback if
+    the import failed and the parsing stats of the file: wall time, number of
+    DAGs and tasks, peak resident memory of the process (in KB) and how much
+    the import raised it.
+    '''
+    mod_name, file_ext = os.path.splitext(os.path.split(filepath)[-1])
+    mod_name = 'unusual_prefix_' + mod_name
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    m = None
+    dags = []
+    error = None
+    timed_out = False
+    try:
+        if mod_name in sys.modules:
+            del sys.modules[mod_name]
+        with utils.timeout(
+                import_timeout,
+                "Importing {} took over {}s".format(filepath, import_timeout)):
+            m = imp.load_source(mod_name, filepath)
+        dags = [o for o in m.__dict__.values() if isinstance(o, DAG)]
+    except utils.AirflowTimeout:
+        timed_out = True
+        error = traceback.format_exc()
+    except:
+        error = traceback.format_exc()
+
+    peak_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stats = {
+        'filepath': filepath,
+        'duration': time.time() - start,
+        'dag_count': len(dags),
+        'task_count': sum([len(dag.tasks) for dag in dags]),
+        'maxrss_kb': peak_maxrss,
+        'maxrss_delta_kb': peak_maxrss - maxrss,
+        'timed_out': timed_out,
+        'failed': error is not None,
+        'parsed_at': datetime.now(),
+    }
+    return m, dags, error, stats
+
+
+_worker_import_timeout = 0
+
+
+def _init_parse_worker(import_timeout=0):
+    global _worker_import_timeout
+    _worker_import_timeout = import_timeout
+    # DAG files may hit the database, the connections inherited from the
+    # parent process can't be shared
+    settings.Session.remove()
+    settings.engine.dispose()
+
+
+def _parse_dag_file(filepath):
+    '''
+    Imports a DAG file in one of the DagBag's parsing processes. Returns the
+    path, the DAGs found pickled with dill (None if they can't be), the
+    traceback if the import failed and the parsing stats of the file.
+    '''
+    m, dags, error, stats = _import_dag_file(
+        filepath, _worker_import_timeout)
+    if error:
+        return filepath, None, error, stats
+
+    # Functions of the module get pickled by value once it's out of
+    # sys.modules, as the parent can't import it. The module is still
+    # referenced so that its globals don't get cleared
+    del sys.modules[m.__name__]
+    try:
+        return filepath, dill.dumps(dags, recurse=True), None, stats
+    except:
+        logging.debug(traceback.format_exc())
+        return filepath, None, None, stats
+
+
+def _load_pickled_dags(pickled_dags):
+    # The operators are loaded as top level modules that the DAGs
+    # reference, they need to be imported before unpickling
+    from airflow import operators  # noqa
+    try:
+        return dill.loads(pickled_dags)
+    except:
+        logging.debug(traceback.format_exc())
+
+
+class DagParseCache(object):
+    """
+    Cache of the DAGs parsed out of DAG files, keyed by a hash of the content
+    of the file and of the local modules it imports. A file whose content
+    didn't change, say after a git sync touched it or when a new DagBag
+    processes it, isn't imported again.
+
+    The DAGs are kept pickled in memory, and when a ``folder`` is specified
+    they are also written there so that they survive restarts. Every hit
+    unpickles its own copy of the DAGs, so that the DagBags sharing the
+    cache don't see the changes made to each other's DAGs. DAGs that can't
+    be pickled aren't cached. Only python modules are tracked, a DAG built
+    out of files or templates read at import time won't see them change.
+
+    :param folder: the folder to persist the cache to
+    :type folder: string
+    """
+    def __init__(self, folder=None):
+        self.folder = folder
+        self.pickled_dags = {}
+        self.file_keys = {}
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    @staticmethod
+    def local_modules(filepath):
+        """
+        Returns the paths of the python files under the DAG file's folder or
+        the DAGS_FOLDER that the DAG file imports, directly or not
+        """
+        paths = [filepath]
+        i = 0
+        while i < len(paths):
+            path = paths[i]
+            i += 1
+            try:
+                with open(path) as f:
+                    tree = ast.parse(f.read(), path)
+            except (IOError, SyntaxError, TypeError):
+                continue
+            for node in ast.walk(tree):
+                folders = [os.path.dirname(path), DAGS_FOLDER]
+                if isinstance(node, ast.Import):
+                    names = [alias.name for alias in node.names]
+                elif isinstance(node, ast.ImportFrom):
+                    module = node.module or ''
+                    names = [module] + [
+                        (module + '.' if module else '') + alias.name
+                        for alias in node.names]
+                    if node.level:
+                        folder = os.path.dirname(path)
+                        for _ in range(node.level - 1):
+                            folder = os.path.dirname(folder)
+                        folders = [folder]
+                else:
+                    continue
+                for name in names:
+                    if not name:
+                        continue
+                    parts = name.split('.')
+                    for folder in folders:
+                        module_path = os.path.join(folder, *parts)
+                        for candidate in (
+                                module_path + '.py',
+                                os.path.join(module_path, '__init__.py')):
+                            if (
+                                    os.path.isfile(candidate) and
+                                    candidate not in paths):
+                                paths.append(candidate)
+        return paths
+
+    def key(self, filepath):
+        sha = hashlib.sha1()
+        for path in self.local_modules(filepath):
+            sha.update(path)
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+        return sha.hexdigest()
+
+    def get(self, key):
+        """
+        Returns a copy of the DAGs cached for the key, None on a miss
+        """
+        pickled_dags = self.pickled_dags.get(key)
+        if pickled_dags is None and self.folder:
+            path = os.path.join(self.folder, key + '.pkl')
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    pickled_dags = f.read()
+        if pickled_dags is None:
+            return None
+        dags = _load_pickled_dags(pickled_dags)
+        if dags is None:
+            self.pickled_dags.pop(key, None)
+        else:
+            self.pickled_dags[key] = pickled_dags
+        return dags
+
+    def set(self, filepath, key, dags, mod_name=None, pickled_dags=None):
+        """
+        Caches the DAGs of a file, replacing the previous version. The DAGs
+        are pickled with the file's module out of ``sys.modules`` so that
+        its functions get pickled by value
+        """
+        previous_key = self.file_keys.get(filepath)
+        if previous_key and previous_key != key:
+            self.pickled_dags.pop(previous_key, None)
+            if self.folder:
+                try:
+                    os.remove(os.path.join(self.folder, previous_key + '.pkl'))
+                except OSError:
+                    pass
+        self.file_keys[filepath] = key
+        if pickled_dags is None:
+            module = sys.modules.pop(mod_name, None)
+            try:
+                pickled_dags = dill.dumps(dags, recurse=True)
+            except:
+                logging.debug(traceback.format_exc())
+                return
+            finally:
+                if module:
+                    sys.modules[mod_name] = module
+        self.pickled_dags[key] = pickled_dags
+
+        if not self.folder:
+            return
+        path = os.path.join(self.folder, key + '.pkl')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(pickled_dags)
+        os.rename(path + '.tmp', path)
+
+
+_dag_parse_cache = None
+
+
+def get_dag_parse_cache():
+    """
+    Returns the process wide DagParseCache, as configured by
+    ``[core] dag_parse_cache``, or None when disabled
+    """
+    global _dag_parse_cache
+    mode = conf.get('core', 'DAG_PARSE_CACHE').lower()
+    if mode not in ('memory', 'disk'):
+        return None
+    if _dag_parse_cache is None:
+        folder = None
+        if mode == 'disk':
+            folder = os.path.expanduser(
+                conf.get('core', 'DAG_PARSE_CACHE_FOLDER') or
+                os.path.join(settings.AIRFLOW_HOME, 'dag_parse_cache'))
+        _dag_parse_cache = DagParseCache(folder)
+    return _dag_parse_cache
+
+
+_ignore_patterns = {}
+
+
+def get_ignore_patterns(directory):
+    """
+    Returns the compiled regexes of the ``.airflowignore`` file of the
+    directory, compiled again only when the file changes
+    """
+    ignore_file = os.path.join(directory, '.airflowignore')
+    try:
+        mtime = os.path.getmtime(ignore_file)
+    except OSError:
+        return []
+    if _ignore_patterns.get(ignore_file, (None,))[0] != mtime:
+        with open(ignore_file) as f:
+            patterns = [re.compile(p) for p in f.read().split('\n') if p]
+        _ignore_patterns[ignore_file] = (mtime, patterns)
+    return _ignore_patterns[ignore_file][1]
+
+
+def walk_dag_folder(dag_folder, patterns=()):
+    """
+    Walks a DAG folder, yielding the directories along with the patterns
+    that apply to them and the python files they hold that aren't ignored.
+    The patterns of an ``.airflowignore`` file apply to the paths under its
+    directory, ignored directories are pruned without being walked.
+
+    :param dag_folder: the folder to walk
+    :type dag_folder: string
+    :param patterns: patterns inherited from the parent directories
+    :type patterns: list
+    """
+    inherited_patterns = {dag_folder: list(patterns)}
+    for root, dirs, files in os.walk(dag_folder):
+        patterns = inherited_patterns.pop(root) + get_ignore_patterns(root)
+        dirs[:] = [
+            d for d in dirs
+            if not any([p.search(os.path.join(root, d)) for p in patterns])]
+        for d in dirs:
+            inherited_patterns[os.path.join(root, d)] = patterns
+        filepaths = []
+        for f in files:
+            filepath = os.path.join(root, f)
+            if (
+                    f.endswith('.py') and
+                    not any([p.search(filepath) for p in patterns]) and
+                    os.path.isfile(filepath)):
+                filepaths.append(filepath)
+        yield root, patterns, filepaths
+
+
+class DagFolderWatcher(object):
+    """
+    Keeps track of the python files of a DAG folder that changed, so that
+    a DagBag only processes those instead of walking the whole folder. On
+    Linux the folder is watched with inotify, elsewhere, or when inotify
+    runs out of watches, the folder is walked and the modification times
+    compared on every ``poll``.
+
+    :param dag_folder: the folder to watch
+    :type dag_folder: string
+    :param use_inotify: whether to use inotify when available
+    :type use_inotify: bool
+    """
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_ONLYDIR = 0x1000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0x80000
+    WATCH_MASK = (
+        IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, dag_folder, use_inotify=True):
+        self.dag_folder = dag_folder
+        self.files = set()
+        self.pending = set()
+        self.mtimes = {}
+        self.dir_patterns = {}
+        self.watches = {}
+        self.libc = None
+        self.fd = None
+        if use_inotify and sys.platform.startswith('linux'):
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if hasattr(libc, 'inotify_init1'):
+                self.libc = libc
+        self.scan()
+
+    @property
+    def inotify(self):
+        return self.fd is not None
+
+    def scan(self):
+        """
+        Walks the whole folder, setting up the watches, and marks all the
+        files as changed
+        """
+        self.close()
+        self.files = set()
+        self.dir_patterns = {}
+        if self.libc:
+            fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+        self.add_tree(self.dag_folder)
+        if not self.inotify:
+            self.mtimes = self.stat_files()
+        self.pending |= self.files
+
+    def add_tree(self, directory, patterns=()):
+        for root, patterns, filepaths in walk_dag_folder(directory, patterns):
+            self.dir_patterns[root] = patterns
+            self.files |= set(filepaths)
+            if self.inotify:
+                self.add_watch(root)
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(
+            self.fd, ctypes.c_char_p(directory), self.WATCH_MASK)
+        if wd < 0:
+            logging.warning(
+                "Can't watch {} ({}), polling the DAG folder "
+                "instead".format(directory, os.strerror(ctypes.get_errno())))
+            self.close()
+            self.libc = None
+            return
+        self.watches[wd] = directory
+
+    def stat_files(self):
+        mtimes = {}
+        for filepath in self.files:
+            try:
+                mtimes[filepath] = os.path.getmtime(filepath)
+            except OSError:
+                pass
+        return mtimes
+
+    def read_events(self):
+        """
+        Adds the paths changed since the last call to ``pending``
+        """
+        if not self.inotify:
+            self.files = set()
+            self.add_tree(self.dag_folder)
+            mtimes = self.stat_files()
+            self.pending |= set([
+                filepath for filepath in set(mtimes) | set(self.mtimes)
+                if mtimes.get(filepath) != self.mtimes.get(filepath)])
+            self.mtimes = mtimes
+            return
+
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            rescan = False
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(
+                    buf, offset)
+                offset += self.EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    rescan = True
+                elif wd in self.watches:
+                    rescan |= self.handle_event(
+                        self.watches[wd], name, mask)
+            if rescan:
+                self.scan()
+                return
+
+    def handle_event(self, directory, name, mask):
+        """
+        Records an inotify event, returns whether it calls for a rescan of
+        the folder, as when ignore patterns change
+        """
+        if mask & self.IN_DELETE_SELF:
+            return directory == self.dag_folder
+        if name == '.airflowignore':
+            return True
+        path = os.path.join(directory, name)
+        patterns = self.dir_patterns.get(directory, [])
+        if any([p.search(path) for p in patterns]):
+            return False
+        if mask & self.IN_ISDIR:
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                new_files = set(self.files)
+                self.add_tree(path, patterns)
+                self.pending |= self.files - new_files
+            elif mask & self.IN_MOVED_FROM:
+                return True
+            return False
+        if not name.endswith('.py'):
+            return False
+        if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            self.files.discard(path)
+        else:
+            self.files.add(path)
+        self.pending.add(path)
+        return False
+
+    def has_changes(self):
+        self.read_events()
+        return bool(self.pending)
+
+    def poll(self):
+        """
+        Returns the paths of the python files created, modified or deleted
+        since the last call
+        """
+        self.read_events()
+        changed = self.pending
+        self.pending = set()
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.watches = {}
+
+    def __del__(self):
+        self.close()
+
+
 def clear_task_instances(tis, session):
     '''
     Clears a set of task instances, but makes sure the running ones
@@ -77,30 +574,109 @@ class DagBag(object):
         the metadata DB while finding them, typically should be done
         by the scheduler job only
     :type sync_to_db: bool
+    :param file_filter: a function taking the path of a python file and
+        returning whether it should be processed. When set, the DagBag
+        only holds part of the DAGs so it doesn't deactivate the ones it
+        didn't find
+    :type file_filter: function
+    :param parse_processes: number of processes the DAG files are imported
+        in. The DAGs are sent back pickled, the files which DAGs can't be
+        pickled (for instance because they hold instances of classes
+        defined in the file) are imported again in the DagBag's process
+    :type parse_processes: int
+    :param parse_cache: the cache of parsed files to use, defaults to the
+        one configured with ``[core] dag_parse_cache``. False disables it
+    :type parse_cache: DagParseCache
+    :param import_timeout: number of seconds after which the import of a
+        file is abandoned, keeping the DAGs previously loaded from it
+    :type import_timeout: int
+    :param watch: whether to watch the DAG folder so that collecting the
+        DAGs again only processes the files that changed
+    :type watch: bool
+    :param freshness_ttl: number of seconds the expiry dates of the DAGs,
+        that ``get_dag`` checks, are cached for
+    :type freshness_ttl: int
     """
     def __init__(
             self,
             dag_folder=None,
             executor=DEFAULT_EXECUTOR,
             include_examples=conf.getboolean('core', 'LOAD_EXAMPLES'),
-            sync_to_db=False):
+            sync_to_db=False,
+            file_filter=None,
+            parse_processes=conf.getint('core', 'DAGBAG_PARSE_PROCESSES'),
+            parse_cache=None,
+            import_timeout=conf.getint('core', 'DAGBAG_IMPORT_TIMEOUT'),
+            watch=False,
+            freshness_ttl=conf.getint('core', 'DAG_FRESHNESS_TTL')):
 
         dag_folder = dag_folder or DAGS_FOLDER
         logging.info("Filling up the DagBag from " + dag_folder)
         self.dag_folder = dag_folder
         self.dags = {}
         self.sync_to_db = sync_to_db
+        self.file_filter = file_filter
+        self.parse_processes = parse_processes
+        if parse_cache is None:
+            parse_cache = get_dag_parse_cache()
+        self.parse_cache = parse_cache
+        self.import_timeout = import_timeout
         self.file_last_changed = {}
+        self.file_stats = {}
+        self.pending_orm_dags = {}
+        self.freshness_ttl = freshness_ttl
+        self.expiry_snapshot = {}
+        self.expiry_snapshot_at = None
         self.executor = executor
+        self.watcher = None
+        if watch and os.path.isdir(dag_folder):
+            self.watcher = DagFolderWatcher(dag_folder)
         self.collect_dags(dag_folder)
         if include_examples:
             example_dag_folder = os.path.join(
                 os.path.dirname(__file__),
                 'example_dags')
             self.collect_dags(example_dag_folder)
-        if sync_to_db:
+        if sync_to_db and not file_filter:
             self.deactivate_inactive_dags()
 
+    @classmethod
+    def for_dag(
+            cls, dag_id, dag_folder=None,
+            include_examples=conf.getboolean('core', 'LOAD_EXAMPLES')):
+        """
+        Returns a DagBag holding the DAG, parsing only the file defining it
+        when that file is known, from the ``dag`` table or because
+        ``dag_folder`` is a file, and lives within ``dag_folder``. Falls
+        back to parsing the whole ``dag_folder``.
+        """
+        dag_folder = dag_folder or DAGS_FOLDER
+        filepaths = []
+        orm_dag = DagModel.get_current(dag_id)
+        if orm_dag and orm_dag.fileloc:
+            filepaths.append(orm_dag.fileloc)
+        if os.path.isfile(dag_folder):
+            filepaths.append(dag_folder)
+        folder = os.path.abspath(dag_folder)
+        example_dag_folder = os.path.abspath(os.path.join(
+            os.path.dirname(__file__), 'example_dags'))
+        for filepath in filepaths:
+            path = os.path.abspath(filepath)
+            within_folder = (
+                path == folder or
+                path.startswith(folder + os.sep) or
+                include_examples and path.startswith(
+                    example_dag_folder + os.sep))
+            if not within_folder or not os.path.isfile(filepath):
+                continue
+            dagbag = cls(filepath, include_examples=False)
+            if dag_id in dagbag.dags:
+                return dagbag
+        logging.info(
+            "The file defining {} isn't known, parsing {}".format(
+                dag_id, dag_folder))
+        return cls(dag_folder, include_examples=include_examples)
+
     def get_dag(self, dag_id):
         """
         Gets the DAG out of the dictionary, and refreshes it if expired
@@ -108,37 +684,138 @@ class DagBag(object):
         if dag_id in self.dags:
             dag = self.dags[dag_id]
             if dag.is_subdag:
-                orm_dag = DagModel.get_current(dag.parent_dag.dag_id)
+                expiry = self.get_expiry(dag.parent_dag.dag_id)
             else:
-                orm_dag = DagModel.get_current(dag_id)
-            if orm_dag and dag.last_loaded < (
-                    orm_dag.last_expired or datetime(2100, 1, 1)):
-                self.process_file(
-                    filepath=orm_dag.fileloc, only_if_updated=False)
+                expiry = self.get_expiry(dag_id)
+            if expiry and expiry[0] and dag.last_loaded < expiry[0]:
+                self.process_file(filepath=expiry[1], only_if_updated=False)
                 dag = self.dags[dag_id]
         else:
-            orm_dag = DagModel.get_current(dag_id)
-            self.process_file(
-                filepath=orm_dag.fileloc, only_if_updated=False)
-            if dag_id in self.dags:
-                dag = self.dags[dag_id]
-            else:
-                dag = None
+            expiry = self.get_expiry(dag_id)
+            if not expiry:
+                # The DAG may have been added since the last snapshot
+                self.expire_snapshot()
+                expiry = self.get_expiry(dag_id)
+            if expiry and expiry[1]:
+                self.process_file(filepath=expiry[1], only_if_updated=False)
+            dag = self.dags.get(dag_id)
+        self.sync_orm_dags()
         return dag
 
+    def get_expiry(self, dag_id):
+        """
+        Returns the ``(last_expired, fileloc)`` of a DAG, out of a snapshot
+        of the ``dag`` table taken at most ``freshness_ttl`` seconds ago, so
+        that successive calls share a single query
+        """
+        if (
+                self.expiry_snapshot_at is None or
+                datetime.now() - self.expiry_snapshot_at >
+                timedelta(seconds=self.freshness_ttl)):
+            session = settings.Session()
+            self.expiry_snapshot = dict([
+                (dag_id_, (last_expired, fileloc))
+                for dag_id_, last_expired, fileloc in session.query(
+                    DagModel.dag_id, DagModel.last_expired,
+                    DagModel.fileloc)])
+            session.commit()
+            session.close()
+            self.expiry_snapshot_at = datetime.now()
+        return self.expiry_snapshot.get(dag_id)
+
+    def expire_snapshot(self):
+        """
+        Makes the next ``get_dag`` read the expiry dates of the DAGs again
+        """
+        self.expiry_snapshot_at = None
+
     def process_file(self, filepath, only_if_updated=True, safe_mode=True):
         """
         Given a path to a python module, this method imports the module and
         look for dag objects whithin it.
         """
+        dttm = self.file_due(filepath, only_if_updated, safe_mode)
+        if not dttm:
+            return
+
+        key = None
+        if self.parse_cache:
+            key = self.parse_cache.key(filepath)
+            # Files explicitly reprocessed skip the cache
+            if only_if_updated and self.bag_cached_dags(filepath, key, dttm):
+                return
+
+        logging.info("Importing " + filepath)
+        m, dags, error, stats = _import_dag_file(
+            filepath, self.import_timeout)
+        self.record_file_stats(stats)
+        if error:
+            self.import_failed(filepath, error, stats, dttm)
+            return
+
+        if self.parse_cache:
+            self.parse_cache.set(filepath, key, dags, mod_name=m.__name__)
+        self.bag_file_dags(dags, filepath, dttm)
+
+    def import_failed(self, filepath, error, stats, dttm):
+        """
+        Logs the failure, the DAGs previously loaded from the file stay in
+        the bag until the file changes
+        """
+        if stats['timed_out']:
+            logging.error(
+                "Timed out importing {} after {}s, keeping the DAGs "
+                "previously loaded from it".format(
+                    filepath, self.import_timeout))
+        else:
+            logging.error("Failed to import: " + filepath)
+        logging.error(error)
+        self.file_last_changed[filepath] = dttm
+
+    def record_file_stats(self, stats):
+        """
+        Keeps the parsing stats of a file in ``file_stats`` and sends them
+        to statsd
+        """
+        self.file_stats[stats['filepath']] = stats
+        if not settings.statsd:
+            return
+        name = os.path.splitext(os.path.basename(stats['filepath']))[0]
+        name = name.replace('.', '_')
+        statsd = settings.statsd
+        statsd.timing(
+            'dag.loading-duration.' + name, stats['duration'] * 1000)
+        statsd.gauge('dag.dag_count.' + name, stats['dag_count'])
+        statsd.gauge('dag.task_count.' + name, stats['task_count'])
+        statsd.gauge('dag.maxrss_delta_kb.' + name, stats['maxrss_delta_kb'])
+        if stats['timed_out']:
+            statsd.incr('dag.import_timeout', 1, 1)
+        elif stats['failed']:
+            statsd.incr('dag.import_error', 1, 1)
+
+    def bag_cached_dags(self, filepath, key, dttm):
+        """
+        Bags the DAGs of the file from the parse cache, returns whether
+        they were found in it
+        """
+        dags = self.parse_cache.get(key)
+        if dags is None:
+            return False
+        logging.info("Reusing the DAGs parsed from " + filepath)
+        self.bag_file_dags(dags, filepath, dttm)
+        return True
+
+    def file_due(self, filepath, only_if_updated=True, safe_mode=True):
+        """
+        Returns the modification time of a DAG file if it should be
+        imported, None otherwise
+        """
         try:
             # This failed before in what may have been a git sync
             # race condition
             dttm = datetime.fromtimestamp(os.path.getmtime(filepath))
         except:
             dttm = datetime(2001, 1, 1)
-        mod_name, file_ext = os.path.splitext(os.path.split(filepath)[-1])
-        mod_name = 'unusual_prefix_' + mod_name
 
         if safe_mode:
             # Skip file if no obvious references to airflow or DAG are found.
@@ -152,25 +829,73 @@ class DagBag(object):
                 not only_if_updated or
                 filepath not in self.file_last_changed or
                 dttm != self.file_last_changed[filepath]):
-            try:
-                logging.info("Importing " + filepath)
-                if mod_name in sys.modules:
-                    del sys.modules[mod_name]
-                m = imp.load_source(mod_name, filepath)
-            except:
-                logging.error("Failed to import: " + filepath)
-                logging.exception("")
-                self.file_last_changed[filepath] = dttm
-                return
-
-            for dag in m.__dict__.values():
-                if isinstance(dag, DAG):
-                    dag.full_filepath = filepath
-                    dag.is_subdag = False
-                    self.bag_dag(dag, parent_dag=dag, root_dag=dag)
-                    # dag.pickle()
-
-            self.file_last_changed[filepath] = dttm
+            return dttm
+
+    def bag_file_dags(self, dags, filepath, dttm):
+        """
+        Adds the DAGs found in a file to the bag
+        """
+        for dag in dags:
+            dag.full_filepath = filepath
+            dag.is_subdag = False
+            self.bag_dag(dag, parent_dag=dag, root_dag=dag)
+            # dag.pickle()
+
+        self.file_last_changed[filepath] = dttm
+
+    def process_files_in_pool(self, filepaths, only_if_updated=True):
+        """
+        Imports the DAG files that are due in ``parse_processes`` forked
+        processes. A file failing to import or to be pickled doesn't affect
+        the others.
+        """
+        due = {}
+        keys = {}
+        for filepath in filepaths:
+            dttm = self.file_due(filepath, only_if_updated)
+            if not dttm:
+                continue
+            if self.parse_cache:
+                keys[filepath] = self.parse_cache.key(filepath)
+                if (
+                        only_if_updated and
+                        self.bag_cached_dags(filepath, keys[filepath], dttm)):
+                    continue
+            due[filepath] = dttm
+        if not due:
+            return
+
+        logging.info("Importing {} files in {} processes".format(
+            len(due), self.parse_processes))
+        pool = multiprocessing.Pool(
+            min(self.parse_processes, len(due)),
+            initializer=_init_parse_worker,
+            initargs=(self.import_timeout,))
+        try:
+            results = pool.map(_parse_dag_file, sorted(due))
+        finally:
+            pool.close()
+            pool.join()
+
+        for filepath, pickled_dags, error, stats in results:
+            self.record_file_stats(stats)
+            if error:
+                self.import_failed(filepath, error, stats, due[filepath])
+                continue
+            dags = None
+            if pickled_dags is not None:
+                dags = _load_pickled_dags(pickled_dags)
+            if dags is None:
+                logging.info(
+                    "DAGs of {} can't be sent across processes, "
+                    "importing it again".format(filepath))
+                self.process_file(filepath, only_if_updated=False)
+            else:
+                if self.parse_cache:
+                    self.parse_cache.set(
+                        filepath, keys[filepath], dags,
+                        pickled_dags=pickled_dags)
+                self.bag_file_dags(dags, filepath, due[filepath])
 
     def bag_dag(self, dag, parent_dag, root_dag):
         """
@@ -181,18 +906,14 @@ class DagBag(object):
         dag.last_loaded = datetime.now()
 
         if self.sync_to_db:
-            session = settings.Session()
-            orm_dag = session.query(
-                DagModel).filter(DagModel.dag_id == dag.dag_id).first()
-            if not orm_dag:
-                orm_dag = DagModel(dag_id=dag.dag_id)
-            orm_dag.fileloc = root_dag.full_filepath
-            orm_dag.is_subdag = dag.is_subdag
-            orm_dag.owners = root_dag.owner
-            orm_dag.is_active = True
-            session.merge(orm_dag)
-            session.commit()
-            session.close()
+            # Synced in bulk by sync_orm_dags
+            self.pending_orm_dags[dag.dag_id] = {
+                'dag_id': dag.dag_id,
+                'fileloc': root_dag.full_filepath,
+                'is_subdag': dag.is_subdag,
+                'owners': root_dag.owner,
+                'is_active': True,
+            }
 
         for subdag in dag.subdags:
             subdag.full_filepath = dag.full_filepath
@@ -212,38 +933,73 @@ class DagBag(object):
 
         Note that if a .airflowignore file is found while processing,
         the directory, it will behaves much like a .gitignore does,
-        ignoring files that match any of the regex patterns specified
-        in the file.
+        ignoring files under the directory that match any of the regex
+        patterns specified in the file.
+
+        When the DagBag watches its folder, only the files that changed
+        since the last collection are processed.
         """
-        if os.path.isfile(dag_folder):
-            self.process_file(dag_folder, only_if_updated=only_if_updated)
+        filepaths = []
+        if (
+                self.watcher and only_if_updated and
+                dag_folder == self.watcher.dag_folder):
+            filepaths = sorted([
+                filepath for filepath in self.watcher.poll()
+                if os.path.isfile(filepath)])
+        elif os.path.isfile(dag_folder):
+            filepaths.append(dag_folder)
         elif os.path.isdir(dag_folder):
-            patterns = []
-            for root, dirs, files in os.walk(dag_folder):
-                ignore_file = [f for f in files if f == '.airflowignore']
-                if ignore_file:
-                    f = open(os.path.join(root, ignore_file[0]), 'r')
-                    patterns += [p for p in f.read().split('\n') if p]
-                    f.close()
-                for f in files:
-                    filepath = os.path.join(root, f)
-                    if not os.path.isfile(filepath):
-                        continue
-                    mod_name, file_ext = os.path.splitext(
-                        os.path.split(filepath)[-1])
-                    if file_ext != '.py':
-                        continue
-                    if not any([re.findall(p, filepath) for p in patterns]):
-                        self.process_file(
-                            filepath, only_if_updated=only_if_updated)
+            for root, patterns, files in walk_dag_folder(dag_folder):
+                filepaths += files
+        if self.file_filter:
+            filepaths = [f for f in filepaths if self.file_filter(f)]
+
+        if self.parse_processes > 1 and len(filepaths) > 1:
+            self.process_files_in_pool(
+                filepaths, only_if_updated=only_if_updated)
+        else:
+            for filepath in filepaths:
+                self.process_file(filepath, only_if_updated=only_if_updated)
+        self.sync_orm_dags()
+
+    def sync_orm_dags(self, chunk_size=500):
+        """
+        Inserts or updates the DagModel rows of the DAGs bagged since the
+        last call, in a single transaction. If it fails, the rows are kept
+        for the next call.
+        """
+        if not self.pending_orm_dags:
+            return
+        pending = self.pending_orm_dags
+        dag_ids = sorted(pending)
+        session = settings.Session()
+        try:
+            existing = set()
+            for i in range(0, len(dag_ids), chunk_size):
+                existing |= set([
+                    dag_id for dag_id, in session.query(
+                        DagModel.dag_id).filter(
+                        DagModel.dag_id.in_(dag_ids[i:i + chunk_size]))])
+            session.bulk_update_mappings(
+                DagModel, [pending[dag_id] for dag_id in existing])
+            session.bulk_insert_mappings(DagModel, [
+                pending[dag_id] for dag_id in dag_ids
+                if dag_id not in existing])
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self.pending_orm_dags = {}
 
     def deactivate_inactive_dags(self):
         active_dag_ids = [dag.dag_id for dag in self.dags.values()]
         session = settings.Session()
-        for dag in session.query(
-                DagModel).filter(~DagModel.dag_id.in_(active_dag_ids)).all():
-            dag.is_active = False
-            session.merge(dag)
+        session.query(DagModel).filter(
+            DagModel.is_active == True,
+            ~DagModel.dag_id.in_(active_dag_ids),
+        ).update({DagModel.is_active: False}, synchronize_session=False)
         session.commit()
         session.close()
 
@@ -345,10 +1101,18 @@ class DagPickle(Base):
         self.dag_id = dag.dag_id
         if hasattr(dag, 'template_env'):
             dag.template_env = None
+        dag.invalidate_graph_index()
         self.pickle_hash = hash(dag)
         self.pickle = dag
 
 
+# Columns of the task instance table recording the resources its latest
+# try used, filled by LocalTaskJob
+RESOURCE_USAGE_COLUMNS = (
+    'cpu_user_time', 'cpu_system_time', 'max_rss_kb', 'read_bytes',
+    'write_bytes', 'context_switches')
+
+
 class TaskInstance(Base):
     """
     Task instances store the state of a task instance. This table is the
@@ -370,7 +1134,7 @@ class TaskInstance(Base):
     execution_date = Column(DateTime, primary_key=True)
     start_date = Column(DateTime)
     end_date = Column(DateTime)
-    duration = Column(Integer)
+    duration = Column(Float)
     state = Column(String(20))
     try_number = Column(Integer)
     hostname = Column(String(1000))
@@ -379,11 +1143,21 @@ class TaskInstance(Base):
     pool = Column(String(50))
     queue = Column(String(50))
     priority_weight = Column(Integer)
+    # Resource usage of the process tree of the latest try
+    cpu_user_time = Column(Float)
+    cpu_system_time = Column(Float)
+    max_rss_kb = Column(Integer)
+    read_bytes = Column(BigInteger)
+    write_bytes = Column(BigInteger)
+    context_switches = Column(Integer)
+    updated_at = Column(
+        DateTime, default=datetime.now, onupdate=datetime.now)
 
     __table_args__ = (
         Index('ti_dag_state', dag_id, state),
         Index('ti_state_lkp', dag_id, task_id, execution_date, state),
         Index('ti_pool', pool, state, priority_weight),
+        Index('ti_updated_at', updated_at),
     )
 
     def __init__(self, task, execution_date, state=None, job=None):
@@ -482,12 +1256,79 @@ class TaskInstance(Base):
         """
         Forces the task instance's state to FAILED in the database.
         """
-        session = settings.Session()
+        session = main_session or settings.Session()
         logging.error("Recording the task instance as FAILED")
         self.state = State.FAILED
         session.merge(self)
+        get_event_log_sink().record(Log(State.FAILED, self), session)
         session.commit()
-        session.close()
+        if not main_session:
+            session.close()
+
+    def compare_and_set(
+            self, session, expected_state, expected_try_number, event=None):
+        """
+        Writes the task instance to the database with a single UPDATE
+        guarded by the state and try number it is expected to have there,
+        along with a ``Log`` row for ``event``, and commits. A task
+        instance that isn't in the database yet gets inserted when it's
+        expected to have no state.
+
+        Returns False, after rolling the transaction back, when another
+        process changed the task instance in the meantime.
+
+        :param expected_state: the state the task instance is expected to
+            be in, in the database
+        :type expected_state: str
+        :param expected_try_number: the try number the task instance is
+            expected to have, in the database
+        :type expected_try_number: int
+        :param event: the event recorded through the event log sink,
+            if any
+        :type event: str
+        """
+        TI = TaskInstance
+        values = {
+            'state': self.state,
+            'try_number': self.try_number,
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'duration': self.duration,
+            'hostname': self.hostname,
+            'unixname': self.unixname,
+            'job_id': self.job_id,
+            'pool': self.pool,
+            'queue': self.queue,
+            'priority_weight': self.priority_weight,
+        }
+        for column in RESOURCE_USAGE_COLUMNS:
+            values[column] = getattr(self, column)
+        qry = session.query(TI).filter(
+            TI.dag_id == self.dag_id,
+            TI.task_id == self.task_id,
+            TI.execution_date == self.execution_date,
+            TI.state == expected_state,
+            TI.try_number == expected_try_number,
+        )
+        updated = qry.update(values, synchronize_session=False)
+        if not updated and expected_state is None:
+            values.update({
+                'dag_id': self.dag_id,
+                'task_id': self.task_id,
+                'execution_date': self.execution_date,
+            })
+            try:
+                session.execute(TI.__table__.insert().values(**values))
+                updated = 1
+            except IntegrityError:
+                updated = 0
+        if not updated:
+            session.rollback()
+            return False
+        if event:
+            get_event_log_sink().record(Log(event, self), session)
+        session.commit()
+        return True
 
     def refresh_from_db(self, main_session=None):
         """
@@ -517,13 +1358,40 @@ class TaskInstance(Base):
         """
         return (self.dag_id, self.task_id, self.execution_date)
 
-    def is_queueable(self):
+    @classmethod
+    def get_dag_ti_states(cls, dag_id, execution_dates, session):
+        """
+        Returns a dictionary of the task instances of a DAG for a set of
+        execution dates, keyed by ``(task_id, execution_date)``, loaded
+        in a single query. The result can be passed as ``ti_states`` to
+        ``is_queueable``, ``is_runnable`` and ``are_dependencies_met``
+        so that dependencies get evaluated in memory.
+        """
+        execution_dates = list(set(execution_dates))
+        if not execution_dates:
+            return {}
+        tis = session.query(cls).filter(
+            cls.dag_id == dag_id,
+            cls.execution_date.in_(execution_dates),
+        ).all()
+        return {(ti.task_id, ti.execution_date): ti for ti in tis}
+
+    def _known_state(self, ti_states, task_id, execution_date):
+        ti = ti_states.get((task_id, execution_date))
+        return ti.state if ti else None
+
+    def is_queueable(self, ti_states=None):
         """
         Returns a boolean on whether the task instance has met all dependencies
         and is ready to run. It considers the task's state, the state
         of its dependencies, depends_on_past and makes sure the execution
         isn't in the future. It doesn't take into
         account whether the pool has a slot for it to run.
+
+        :param ti_states: task instances of the DAG, as returned by
+            ``get_dag_ti_states``, used to evaluate the dependencies
+            without hitting the database
+        :type ti_states: dict
         """
         if self.execution_date > datetime.now() - self.task.schedule_interval:
             return False
@@ -533,19 +1401,21 @@ class TaskInstance(Base):
             return False
         elif (
                 self.state in State.runnable() and
-                self.are_dependencies_met()):
+                self.are_dependencies_met(ti_states=ti_states)):
             return True
         else:
             return False
 
-    def is_runnable(self):
+    def is_runnable(self, ti_states=None, slot_ledger=None):
         """
         Returns whether a task is ready to run AND there's room in the
         queue.
         """
-        return self.is_queueable() and not self.pool_full()
+        return (
+            self.is_queueable(ti_states=ti_states) and
+            not self.pool_full(slot_ledger=slot_ledger))
 
-    def are_dependents_done(self, main_session=None):
+    def are_dependents_done(self, main_session=None, ti_states=None):
         """
         Checks whether the dependents of this task instance have all succeeded.
         This is meant to be used by wait_for_downstream.
@@ -561,6 +1431,13 @@ class TaskInstance(Base):
             return True
 
         downstream_task_ids = [t.task_id for t in task._downstream_list]
+        if ti_states is not None:
+            return all(
+                self._known_state(
+                    ti_states, task_id, self.execution_date) == State.SUCCESS
+                for task_id in downstream_task_ids)
+
+        session = main_session or settings.Session()
         ti = session.query(func.count(TaskInstance.task_id)).filter(
             TaskInstance.dag_id == self.dag_id,
             TaskInstance.task_id.in_(downstream_task_ids),
@@ -573,16 +1450,21 @@ class TaskInstance(Base):
             session.close()
         return count == len(task._downstream_list)
 
-    def are_dependencies_met(self, main_session=None):
+    def are_dependencies_met(self, main_session=None, ti_states=None):
         """
         Returns a boolean on whether the upstream tasks are in a SUCCESS state
         and considers depends_on_past and the previous run's state.
+
+        When ``ti_states`` is passed, the states are looked up in that
+        dictionary (see ``get_dag_ti_states``) instead of the database.
         """
         TI = TaskInstance
+        task = self.task
+        if ti_states is not None:
+            return self._are_dependencies_met_in_memory(ti_states)
 
         # Using the session if passed as param
         session = main_session or settings.Session()
-        task = self.task
 
         # Checking that the depends_on_past is fulfilled
         if (task.depends_on_past and
@@ -621,6 +1503,117 @@ class TaskInstance(Base):
             session.close()
         return True
 
+    def _are_dependencies_met_in_memory(self, ti_states):
+        """
+        Mirrors ``are_dependencies_met`` against a dictionary of known task
+        instances instead of the database.
+        """
+        return self._unmet_dependency(ti_states) is None
+
+    def _unmet_dependency(self, ti_states):
+        """
+        Returns the reason why the dependencies of the task instance
+        aren't met according to ``ti_states``, or None if they are
+        """
+        task = self.task
+        if (task.depends_on_past and
+                not self.execution_date == task.start_date):
+            previous_date = self.execution_date - task.schedule_interval
+            previous_ti = ti_states.get((task.task_id, previous_date))
+            if not previous_ti or previous_ti.state != State.SUCCESS:
+                return "depends_on_past and the previous run didn't succeed"
+            previous_ti.task = task
+            if task.wait_for_downstream and not \
+                    previous_ti.are_dependents_done(ti_states=ti_states):
+                return (
+                    "wait_for_downstream and the downstream tasks of the "
+                    "previous run didn't all succeed")
+
+        pending = [
+            t.task_id for t in task._upstream_list
+            if self._known_state(
+                ti_states, t.task_id, self.execution_date) != State.SUCCESS]
+        if pending:
+            return "upstream tasks didn't all succeed: " + ", ".join(
+                sorted(pending))
+        return None
+
+    def readiness(self, ti_states, slot_ledger=None):
+        """
+        Mirrors ``is_runnable``, or ``is_queueable`` when no
+        ``slot_ledger`` is passed, against a dictionary of known task
+        instances and returns a ``(ready, reason)`` tuple, where reason
+        tells why the task instance isn't ready.
+        """
+        task = self.task
+        if self.execution_date > datetime.now() - task.schedule_interval:
+            return False, "the schedule isn't over yet"
+        elif self.state == State.UP_FOR_RETRY and not self.ready_for_retry():
+            return False, "waiting for the retry delay"
+        elif task.end_date and self.execution_date > task.end_date:
+            return False, "after the task's end_date"
+        elif self.state not in State.runnable():
+            return False, "in the {} state".format(self.state)
+        reason = self._unmet_dependency(ti_states)
+        if reason:
+            return False, reason
+        if slot_ledger is not None and self.pool_full(slot_ledger=slot_ledger):
+            return False, "no open slot in the {} pool".format(task.pool)
+        return True, None
+
+    @classmethod
+    @provide_session
+    def check_readiness(
+            cls, tis, session, check_pool=True, refresh=True):
+        """
+        Evaluates whether each of the task instances is ready to run, with
+        one query loading the task instances it depends on and one query
+        for the pools, whatever the number of task instances.
+
+        :param tis: task instances, with their ``task`` attribute set
+        :type tis: list
+        :param check_pool: whether a task instance whose pool has no open
+            slot is considered ready, the slots aren't taken
+        :type check_pool: bool
+        :param refresh: whether the state, dates and try number of the task
+            instances get refreshed from the database, as
+            ``refresh_from_db`` does
+        :type refresh: bool
+        :return: a ``(ready, reason)`` tuple keyed by task instance key,
+            where reason is None for the task instances that are ready
+        :rtype: dict
+        """
+        tis = list(tis)
+        if not tis:
+            return {}
+        dates = set()
+        for ti in tis:
+            dates.add(ti.execution_date)
+            if ti.task.depends_on_past:
+                dates.add(ti.execution_date - ti.task.schedule_interval)
+        known = session.query(cls).filter(
+            cls.dag_id.in_(list(set([ti.dag_id for ti in tis]))),
+            cls.execution_date.in_(list(dates)),
+        ).all()
+        ti_states = defaultdict(dict)
+        for ti in known:
+            ti_states[ti.dag_id][(ti.task_id, ti.execution_date)] = ti
+        slot_ledger = PoolSlotLedger(session) if check_pool else None
+
+        verdicts = {}
+        for ti in tis:
+            dag_ti_states = ti_states[ti.dag_id]
+            if refresh:
+                db_ti = dag_ti_states.get((ti.task_id, ti.execution_date))
+                if db_ti:
+                    ti.state = db_ti.state
+                    ti.start_date = db_ti.start_date
+                    ti.end_date = db_ti.end_date
+                    ti.try_number = db_ti.try_number
+            verdicts[ti.key] = ti.readiness(
+                dag_ti_states, slot_ledger=slot_ledger)
+        return verdicts
+
     def __repr__(self):
         return (
             "<TaskInstance: {ti.dag_id}.{ti.task_id} "
@@ -636,13 +1629,21 @@ class TaskInstance(Base):
             self.end_date + self.task.retry_delay < datetime.now()
 
     @provide_session
-    def pool_full(self, session):
+    def pool_full(self, session, slot_ledger=None):
         """
         Returns a boolean as to whether the slot pool has room for this
         task to run
+
+        :param slot_ledger: a snapshot of the pools, when passed the
+            database isn't queried
+        :type slot_ledger: PoolSlotLedger
         """
         if not self.task.pool:
             return False
+        if slot_ledger is not None:
+            return (
+                self.task.pool in slot_ledger and
+                slot_ledger.open_slots(self.task.pool) <= 0)
 
         pool = (
             session
@@ -671,7 +1672,9 @@ class TaskInstance(Base):
         task = self.task
         session = settings.Session()
         self.refresh_from_db(session)
-        session.commit()
+        # What the transitions below expect to find in the database
+        prior_state = self.state
+        prior_try_number = self.try_number
         self.job_id = job_id
         iso = datetime.now().isoformat()
         self.hostname = socket.gethostname()
@@ -705,22 +1708,30 @@ class TaskInstance(Base):
             self.start_date = datetime.now()
             if not force and task.pool and self.pool_full(session=session):
                 self.state = State.QUEUED
-                session.merge(self)
-                session.commit()
+                if self.compare_and_set(
+                        session, prior_state, prior_try_number):
+                    logging.info("Pool {} is full, queuing".format(task.pool))
                 session.close()
-                logging.info("Pool {} is full, queuing".format(task.pool))
                 return
             if self.state == State.UP_FOR_RETRY:
                 self.try_number += 1
             else:
                 self.try_number = 1
-            if not test_mode:
-                session.add(Log(State.RUNNING, self))
             self.state = State.RUNNING
             self.end_date = None
-            if not test_mode:
-                session.merge(self)
-            session.commit()
+            for column in RESOURCE_USAGE_COLUMNS:
+                setattr(self, column, None)
+            if test_mode:
+                session.commit()
+            elif not self.compare_and_set(
+                    session, prior_state, prior_try_number,
+                    event=State.RUNNING):
+                session.close()
+                logging.error(
+                    "Task {self} was changed by another process since it "
+                    "was read, not running it".format(**locals()))
+                return
+            session.close()
             if verbose:
                 if mark_success:
                     msg = "Marking success for "
@@ -749,24 +1760,35 @@ class TaskInstance(Base):
                 raise e
 
             # Recording SUCCESS
-            session = settings.Session()
             self.end_date = datetime.now()
             self.set_duration()
             self.state = State.SUCCESS
             if not test_mode:
-                session.add(Log(State.SUCCESS, self))
-                session.merge(self)
+                self.record_transition(event=State.SUCCESS)
+                utils.notify_scheduler()
+            return
 
         session.commit()
+        session.close()
+
+    def record_transition(self, event):
+        """
+        Records the outcome of the try of the task instance that is running,
+        unless another process changed it since it started
+        """
+        session = settings.Session()
+        if not self.compare_and_set(
+                session, State.RUNNING, self.try_number, event=event):
+            logging.error(
+                "Task {} was changed by another process while it ran, "
+                "not recording it as {}".format(self, self.state))
+        session.close()
 
     def record_failure(self, error, test_mode=False):
         logging.exception(error)
         task = self.task
-        session = settings.Session()
         self.end_date = datetime.now()
         self.set_duration()
-        if not test_mode:
-            session.add(Log(State.FAILED, self))
 
         # Let's go deeper
         try:
@@ -784,8 +1806,8 @@ class TaskInstance(Base):
             logging.error(str(e2))
 
         if not test_mode:
-            session.merge(self)
-        session.commit()
+            self.record_transition(event=State.FAILED)
+            utils.notify_scheduler()
         logging.error(str(error))
 
     def get_template_context(self):
@@ -835,7 +1857,7 @@ class TaskInstance(Base):
                     self.task.dag.user_defined_macros)
 
         rt = self.task.render_template  # shortcut to method
-        for attr in task.__class__.template_fields:
+        for attr in task.template_fields:
             content = getattr(task, attr)
             if content:
                 if isinstance(content, basestring):
@@ -865,7 +1887,8 @@ class TaskInstance(Base):
 
     def set_duration(self):
         if self.end_date and self.start_date:
-            self.duration = (self.end_date - self.start_date).seconds
+            self.duration = (
+                self.end_date - self.start_date).total_seconds()
         else:
             self.duration = None
 
@@ -894,6 +1917,196 @@ class Log(Base):
         self.owner = task_instance.task.owner
 
 
+LOG_COLUMNS = (
+    'dttm', 'dag_id', 'task_id', 'event', 'execution_date', 'owner')
+
+
+class EventLogSink(object):
+    """
+    Records the ``Log`` events of the task instances. This sink adds them
+    to the session of the state transition they come with, so they get
+    committed along with it.
+    """
+    def record(self, log, session):
+        session.add(log)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class BufferedEventLogSink(EventLogSink):
+    """
+    Buffers the ``Log`` events in the process, outside of the transactions
+    of the state transitions, and writes them in bulk every
+    ``flush_interval`` seconds, once ``max_buffer`` events are buffered
+    and at exit. Events that fail to be written are kept for the next
+    flush, up to ``max_buffer`` of them.
+
+    :param flush_interval: number of seconds between flushes
+    :type flush_interval: float
+    :param max_buffer: number of events that triggers a flush
+    :type max_buffer: int
+    """
+    def __init__(self, flush_interval=5, max_buffer=1000):
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.lock = threading.Lock()
+        self.reset()
+        atexit.register(self.close)
+
+    def reset(self):
+        # Forked processes start with an empty buffer and their own thread
+        self.pid = os.getpid()
+        self.buffer = []
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def record(self, log, session=None):
+        if self.pid != os.getpid():
+            self.reset()
+        with self.lock:
+            self.buffer.append(dict([
+                (column, getattr(log, column)) for column in LOG_COLUMNS]))
+            full = len(self.buffer) >= self.max_buffer
+            if self.flusher is None and self.flush_interval > 0:
+                self.flusher = threading.Thread(target=self.flush_loop)
+                self.flusher.daemon = True
+                self.flusher.start()
+        if full:
+            self.flush()
+
+    def flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            rows, self.buffer = self.buffer, []
+        if not rows:
+            return
+        try:
+            self.write(rows)
+        except Exception as e:
+            logging.exception(e)
+            with self.lock:
+                self.buffer = (rows + self.buffer)[-self.max_buffer:]
+
+    def write(self, rows):
+        """
+        Inserts the rows in the log table, in a single executemany
+        """
+        session = settings.Session()
+        session.execute(Log.__table__.insert(), rows)
+        session.commit()
+        session.close()
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
+
+
+class FileEventLogSink(BufferedEventLogSink):
+    """
+    Writes the buffered ``Log`` events to files of a local folder instead
+    of the database, one file per flush named after the host and process.
+    ``ship`` loads the files into the log table in bulk.
+
+    :param folder: folder the files are written to
+    :type folder: str
+    """
+    def __init__(self, folder, flush_interval=5, max_buffer=1000):
+        self.folder = folder
+        self.flushes = 0
+        super(FileEventLogSink, self).__init__(
+            flush_interval=flush_interval, max_buffer=max_buffer)
+
+    def write(self, rows):
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.flushes += 1
+        filepath = os.path.join(self.folder, '{}_{}_{}_{}.json'.format(
+            socket.gethostname(), os.getpid(),
+            datetime.now().strftime('%Y%m%dT%H%M%S'), self.flushes))
+        with open(filepath + '.tmp', 'w') as f:
+            for row in rows:
+                f.write(json.dumps(dict([
+                    (k, v.isoformat() if isinstance(v, datetime) else v)
+                    for k, v in row.items()])) + '\n')
+        # Files only show up complete to the shipper
+        os.rename(filepath + '.tmp', filepath)
+
+    @staticmethod
+    def ship(folder, chunk_size=1000):
+        """
+        Loads the event files of the folder into the log table in chunks
+        of ``chunk_size`` rows, and removes them. Returns the number of
+        events loaded.
+        """
+        if not os.path.isdir(folder):
+            return 0
+        count = 0
+        session = settings.Session()
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith('.json'):
+                continue
+            filepath = os.path.join(folder, filename)
+            rows = []
+            with open(filepath) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    for k in ('dttm', 'execution_date'):
+                        if row.get(k):
+                            row[k] = dateutil.parser.parse(row[k])
+                    rows.append(row)
+            for i in range(0, len(rows), chunk_size):
+                session.execute(
+                    Log.__table__.insert(), rows[i:i + chunk_size])
+            session.commit()
+            os.remove(filepath)
+            count += len(rows)
+        session.close()
+        return count
+
+
+_event_log_sink = None
+
+
+def get_event_log_sink():
+    """
+    Returns the process wide EventLogSink, as configured by
+    ``[core] event_log_sink``
+    """
+    global _event_log_sink
+    if _event_log_sink is None:
+        mode = conf.get('core', 'EVENT_LOG_SINK').lower()
+        interval = conf.getfloat('core', 'EVENT_LOG_FLUSH_INTERVAL')
+        if mode == 'buffered':
+            _event_log_sink = BufferedEventLogSink(flush_interval=interval)
+        elif mode == 'file':
+            _event_log_sink = FileEventLogSink(
+                get_event_log_folder(), flush_interval=interval)
+        else:
+            _event_log_sink = EventLogSink()
+    return _event_log_sink
+
+
+def get_event_log_folder():
+    return os.path.expanduser(
+        conf.get('core', 'EVENT_LOG_FOLDER') or
+        os.path.join(settings.AIRFLOW_HOME, 'event_logs'))
+
+
 class BaseOperator(Base):
     """
     Abstract base class for all operators. Since operators create objects that
@@ -1054,6 +2267,9 @@ class BaseOperator(Base):
 
     @property
     def priority_weight_total(self):
+        dag = getattr(self, 'dag', None)
+        if dag and self.task_id in dag.get_task_dict():
+            return dag.graph_index.priority_weight_total[self.task_id]
         return sum([
             t.priority_weight
             for t in self.get_flat_relatives(upstream=False)
@@ -1092,16 +2308,16 @@ class BaseOperator(Base):
         pass
 
     def render_template(self, content, context):
+        exts = self.__class__.template_ext
+        from_file = any([content.endswith(ext) for ext in exts])
         if hasattr(self, 'dag'):
-            env = self.dag.get_template_env()
+            template = self.dag.get_template(content, from_file=from_file)
         else:
             env = jinja2.Environment(cache_size=0)
-
-        exts = self.__class__.template_ext
-        if any([content.endswith(ext) for ext in exts]):
-            template = env.get_template(content)
-        else:
-            template = env.from_string(content)
+            if from_file:
+                template = env.get_template(content)
+            else:
+                template = env.from_string(content)
         return template.render(**context)
 
     def prepare_template(self):
@@ -1119,9 +2335,8 @@ class BaseOperator(Base):
             content = getattr(self, attr)
             if (content and isinstance(content, basestring) and
                     any([content.endswith(ext) for ext in self.template_ext])):
-                env = self.dag.get_template_env()
                 try:
-                    setattr(self, attr, env.loader.get_source(env, content)[0])
+                    setattr(self, attr, self.dag.get_template_source(content))
                 except Exception as e:
                     logging.exception(e)
         self.prepare_template()
@@ -1188,14 +2403,32 @@ class BaseOperator(Base):
 
     def get_flat_relatives(self, upstream=False, l=None):
         """
-        Get a flat list of relatives, either upstream or downstream.
+        Get a flat list of relatives, either upstream or downstream. For a
+        task of a DAG, they come out of the DAG's graph index, in
+        topological order.
         """
         if not l:
             l = []
-        for t in self.get_direct_relatives(upstream):
-            if not utils.is_in(t, l):
+        seen = set([id(t) for t in l])
+        dag = getattr(self, 'dag', None)
+        if dag and dag.get_task_dict().get(self.task_id) is self:
+            index = dag.graph_index
+            if upstream:
+                closure = index.upstream_closure[self.task_id]
+            else:
+                closure = index.downstream_closure[self.task_id]
+            for task_id in index.topological_order:
+                t = index.task_dict[task_id]
+                if task_id in closure and id(t) not in seen:
+                    l.append(t)
+            return l
+        stack = list(reversed(self.get_direct_relatives(upstream)))
+        while stack:
+            t = stack.pop()
+            if id(t) not in seen:
+                seen.add(id(t))
                 l.append(t)
-                t.get_flat_relatives(upstream, l)
+                stack.extend(reversed(t.get_direct_relatives(upstream)))
         return l
 
     def detect_downstream_cycle(self, task=None):
@@ -1263,6 +2496,10 @@ class BaseOperator(Base):
             else:
                 self.append_only_new(task._upstream_list, self)
                 self.append_only_new(self._downstream_list, task)
+            if getattr(task, 'dag', None):
+                task.dag.invalidate_graph_index()
+        if getattr(self, 'dag', None):
+            self.dag.invalidate_graph_index()
         self.detect_downstream_cycle()
 
     def set_downstream(self, task_or_task_list):
@@ -1322,6 +2559,331 @@ class DagModel(Base):
         return obj
 
 
+def _serialize_date(dttm):
+    return dttm.isoformat() if dttm else None
+
+
+def _deserialize_date(s):
+    return dateutil.parser.parse(s) if s else None
+
+
+class SerializedDag(Base):
+    """
+    JSON serialization of the structure of a DAG, written by the scheduler
+    so that the webserver can render DAGs without importing the DAG files.
+    It holds the tasks with their operator class, UI colors and template
+    fields, the edges between them, the schedule and the source code of the
+    file the DAG was defined in.
+    """
+    __tablename__ = "serialized_dag"
+
+    dag_id = Column(String(ID_LEN), primary_key=True)
+    fileloc = Column(String(2000))
+    # Hash of the data and source code, changes with the DAG
+    dag_hash = Column(String(40))
+    data = Column(LongText)
+    source_code = Column(LongText)
+    last_updated = Column(DateTime)
+
+    def __repr__(self):
+        return "<SerializedDag: {self.dag_id}>".format(self=self)
+
+    @staticmethod
+    def serialize(dag):
+        """
+        Returns a JSON serializable dict describing the DAG
+        """
+        tasks = []
+        for task in dag.tasks:
+            template_values = {}
+            for field in task.template_fields:
+                value = getattr(task, field, None)
+                try:
+                    json.dumps(value)
+                except (TypeError, ValueError):
+                    value = str(value)
+                template_values[field] = value
+            tasks.append({
+                'task_id': task.task_id,
+                'task_type': task.__class__.__name__,
+                'ui_color': task.ui_color,
+                'ui_fgcolor': task.ui_fgcolor,
+                'template_fields': list(task.template_fields),
+                'template_values': template_values,
+                'owner': task.owner,
+                'retries': task.retries,
+                'depends_on_past': bool(task.depends_on_past),
+                'start_date': _serialize_date(task.start_date),
+                'end_date': _serialize_date(task.end_date),
+                'pool': task.pool,
+                'queue': task.queue,
+                'priority_weight': task.priority_weight,
+                'downstream_task_ids': sorted(
+                    [t.task_id for t in task.downstream_list]),
+            })
+        schedule_interval = dag.schedule_interval
+        if isinstance(schedule_interval, timedelta):
+            schedule_interval = {
+                'seconds': schedule_interval.total_seconds()}
+        parent_dag = getattr(dag, 'parent_dag', None)
+        return {
+            'dag_id': dag.dag_id,
+            'schedule_interval': schedule_interval,
+            'start_date': _serialize_date(dag.start_date),
+            'end_date': _serialize_date(dag.end_date),
+            'full_filepath': dag.full_filepath,
+            'fileloc': getattr(dag, 'fileloc', dag.full_filepath),
+            'parent_dag_id': parent_dag.dag_id if parent_dag else None,
+            'max_active_runs': dag.max_active_runs,
+            'tasks': tasks,
+        }
+
+    @staticmethod
+    def deserialize(data):
+        """
+        Builds a DAG out of a serialized dict. The tasks are plain
+        BaseOperators carrying the attributes the webserver displays, they
+        can't be executed.
+        """
+        schedule_interval = data['schedule_interval']
+        if isinstance(schedule_interval, dict):
+            schedule_interval = timedelta(
+                seconds=schedule_interval['seconds'])
+        dag = DAG(
+            str(data['dag_id']),
+            schedule_interval=schedule_interval,
+            start_date=_deserialize_date(data['start_date']),
+            end_date=_deserialize_date(data['end_date']),
+            full_filepath=data['full_filepath'],
+            max_active_runs=data['max_active_runs'])
+        dag.fileloc = data['fileloc']
+        dag.is_subdag = bool(data['parent_dag_id'])
+        for t in data['tasks']:
+            task = BaseOperator(
+                task_id=str(t['task_id']),
+                owner=t['owner'],
+                retries=t['retries'],
+                depends_on_past=t['depends_on_past'],
+                start_date=_deserialize_date(t['start_date']),
+                end_date=_deserialize_date(t['end_date']),
+                pool=t['pool'],
+                queue=t['queue'],
+                priority_weight=t['priority_weight'],
+                dag=dag)
+            task.task_type = t['task_type']
+            task.ui_color = t['ui_color']
+            task.ui_fgcolor = t['ui_fgcolor']
+            task.template_fields = t['template_fields']
+            for field, value in t['template_values'].items():
+                setattr(task, field, value)
+        for t in data['tasks']:
+            task = dag.task_dict[t['task_id']]
+            for task_id in t['downstream_task_ids']:
+                if task_id in dag.task_dict:
+                    task.set_downstream(dag.task_dict[task_id])
+        return dag
+
+    @classmethod
+    def write_dags(cls, dags, session):
+        """
+        Stores the serialization of the DAGs, leaving the rows of the DAGs
+        which structure didn't change untouched. Returns the number of rows
+        written.
+        """
+        dags = list(dags)
+        if not dags:
+            return 0
+        hashes = dict(
+            session.query(cls.dag_id, cls.dag_hash)
+            .filter(cls.dag_id.in_([dag.dag_id for dag in dags]))
+            .all())
+        source_codes = {}
+        written = 0
+        for dag in dags:
+            data = json.dumps(cls.serialize(dag), sort_keys=True)
+            fileloc = getattr(dag, 'fileloc', dag.full_filepath)
+            if fileloc not in source_codes:
+                try:
+                    with open(fileloc) as f:
+                        source_codes[fileloc] = f.read()
+                except IOError:
+                    source_codes[fileloc] = None
+            source_code = source_codes[fileloc]
+            dag_hash = hashlib.sha1(data)
+            dag_hash.update(source_code or '')
+            dag_hash = dag_hash.hexdigest()
+            if hashes.get(dag.dag_id) == dag_hash:
+                continue
+            session.merge(cls(
+                dag_id=dag.dag_id,
+                fileloc=fileloc,
+                dag_hash=dag_hash,
+                data=data,
+                source_code=source_code,
+                last_updated=datetime.now()))
+            written += 1
+        return written
+
+
+class SerializedDagBag(object):
+    """
+    Read only counterpart of the DagBag built out of the ``serialized_dag``
+    table instead of the DAG files. The stored hashes are read at most
+    once every ``freshness_ttl`` seconds, and a DAG is deserialized again
+    only when its hash changed.
+
+    :param freshness_ttl: how long, in seconds, the stored hashes are
+        trusted for before being read again
+    :type freshness_ttl: int
+    """
+    def __init__(
+            self,
+            freshness_ttl=conf.getint('core', 'DAG_FRESHNESS_TTL')):
+        self._dags = {}
+        self.dag_hashes = {}
+        self.freshness_ttl = freshness_ttl
+        self.collected_at = None
+        self.collect_dags()
+
+    @property
+    def dags(self):
+        if (
+                self.collected_at is None or
+                datetime.now() - self.collected_at >
+                timedelta(seconds=self.freshness_ttl)):
+            self.collect_dags()
+        return self._dags
+
+    def collect_dags(self):
+        """
+        Reloads the DAGs which stored hash changed and drops the ones which
+        aren't stored anymore
+        """
+        SD = SerializedDag
+        session = settings.Session()
+        hashes = dict(session.query(SD.dag_id, SD.dag_hash).all())
+        stale = [
+            dag_id for dag_id, dag_hash in hashes.items()
+            if self.dag_hashes.get(dag_id) != dag_hash]
+        if stale:
+            for row in session.query(SD).filter(SD.dag_id.in_(stale)):
+                self.load_row(row)
+        session.commit()
+        session.close()
+        for dag_id in set(self._dags) - set(hashes):
+            del self._dags[dag_id]
+            del self.dag_hashes[dag_id]
+        self.link_subdags()
+        self.collected_at = datetime.now()
+
+    def get_dag(self, dag_id):
+        """
+        Gets the DAG, out of hashes read at most ``freshness_ttl`` seconds
+        ago, or read again when the DAG isn't known
+        """
+        dag = self.dags.get(dag_id)
+        if not dag:
+            # The DAG may have been stored since the hashes were read
+            self.collect_dags()
+            dag = self._dags.get(dag_id)
+        return dag
+
+    def expire_snapshot(self):
+        """
+        Makes the next access read the stored hashes again
+        """
+        self.collected_at = None
+
+    def load_row(self, row):
+        data = json.loads(row.data)
+        dag = SerializedDag.deserialize(data)
+        dag.parent_dag_id = data['parent_dag_id']
+        dag.source_code = row.source_code
+        dag.last_loaded = row.last_updated
+        self._dags[row.dag_id] = dag
+        self.dag_hashes[row.dag_id] = row.dag_hash
+
+    def link_subdags(self):
+        for dag in self._dags.values():
+            if dag.parent_dag_id:
+                dag.parent_dag = self._dags.get(dag.parent_dag_id)
+
+
+class DagGraphIndex(object):
+    """
+    Frozen view of the structure of a DAG, built in a single pass over its
+    tasks. It holds a ``task_id -> task`` mapping, adjacency lists, a
+    topological order as well as the upstream and downstream closures and
+    the total priority weight of every task. Edges pointing to tasks that
+    are not part of the DAG are ignored.
+
+    The index is owned by the DAG, which builds it lazily through
+    ``DAG.graph_index`` and drops it whenever tasks or edges change.
+
+    :param dag: the DAG to index
+    :type dag: DAG
+    """
+    def __init__(self, dag):
+        self.task_dict = dict([(t.task_id, t) for t in dag.tasks])
+        self.upstream = {}
+        self.downstream = {}
+        for t in dag.tasks:
+            self.upstream[t.task_id] = [
+                u.task_id for u in t.upstream_list
+                if u.task_id in self.task_dict]
+            self.downstream[t.task_id] = [
+                d.task_id for d in t.downstream_list
+                if d.task_id in self.task_dict]
+
+        # Kahn's algorithm, keeping the DAG's task order among ready tasks
+        indegree = dict([(k, len(v)) for k, v in self.upstream.items()])
+        ready = [t.task_id for t in dag.tasks if not indegree[t.task_id]]
+        ready.reverse()
+        self.topological_order = []
+        while ready:
+            task_id = ready.pop()
+            self.topological_order.append(task_id)
+            for d in reversed(self.downstream[task_id]):
+                indegree[d] -= 1
+                if not indegree[d]:
+                    ready.append(d)
+        if len(self.topological_order) != len(self.task_dict):
+            raise Exception(
+                "Cycle detected in DAG {0}".format(dag.dag_id))
+
+        self.downstream_closure = {}
+        for task_id in reversed(self.topological_order):
+            closure = set()
+            for d in self.downstream[task_id]:
+                closure.add(d)
+                closure |= self.downstream_closure[d]
+            self.downstream_closure[task_id] = frozenset(closure)
+
+        self.upstream_closure = {}
+        for task_id in self.topological_order:
+            closure = set()
+            for u in self.upstream[task_id]:
+                closure.add(u)
+                closure |= self.upstream_closure[u]
+            self.upstream_closure[task_id] = frozenset(closure)
+
+        self.priority_weight_total = {}
+        for task_id, closure in self.downstream_closure.items():
+            self.priority_weight_total[task_id] = sum([
+                self.task_dict[t].priority_weight for t in closure
+            ]) + self.task_dict[task_id].priority_weight
+
+
+# Attributes of a DAG holding its template environment and compiled
+# templates, which aren't pickled, copied nor compared
+TEMPLATE_ENV_ATTRS = ('template_env', 'template_env_key', 'template_cache')
+
+# Content of the template files read by DAG.get_template_source, keyed by
+# search path and name, with the function telling whether it is current
+_template_sources = jinja2.utils.LRUCache(
+    max(1, conf.getint('core', 'TEMPLATE_CACHE_SIZE')))
+
+
 class DAG(object):
     """
     A dag (directed acyclic graph) is a collection of tasks with directional
@@ -1362,6 +2924,10 @@ class DAG(object):
         accessible in templates, namespaced under `params`. These
         params can be overriden at the task level.
     :type params: dict
+    :param max_active_runs: maximum number of execution dates the scheduler
+        keeps in flight for this DAG. When the DAG is behind schedule, all
+        the eligible dates within that window get scheduled at once
+    :type max_active_runs: int
     """
 
     def __init__(
@@ -1372,13 +2938,16 @@ class DAG(object):
             template_searchpath=None,
             user_defined_macros=None,
             default_args=None,
-            params=None):
+            params=None,
+            max_active_runs=conf.getint('core', 'MAX_ACTIVE_RUNS_PER_DAG')):
 
         self.user_defined_macros = user_defined_macros
         self.default_args = default_args or {}
         self.params = params
         utils.validate_key(dag_id)
         self.tasks = []
+        self.task_dict = {}
+        self._graph_index = None
         self.dag_id = dag_id
         self.start_date = start_date
         self.end_date = end_date or datetime.now()
@@ -1388,7 +2957,11 @@ class DAG(object):
             template_searchpath = [template_searchpath]
         self.template_searchpath = template_searchpath
         self.parent_dag = None  # Gets set when DAGs are loaded
+        self.max_active_runs = max_active_runs
         self.last_loaded = datetime.now()
+        self.template_env = None
+        self.template_env_key = None
+        self.template_cache = None
 
     def __repr__(self):
         return "<DAG: {self.dag_id}>".format(self=self)
@@ -1397,6 +2970,19 @@ class DAG(object):
     def task_ids(self):
         return [t.task_id for t in self.tasks]
 
+    @property
+    def graph_index(self):
+        """
+        @property: the DagGraphIndex of this DAG, built on first access
+        and rebuilt after tasks or dependencies change
+        """
+        if getattr(self, '_graph_index', None) is None:
+            self._graph_index = DagGraphIndex(self)
+        return self._graph_index
+
+    def invalidate_graph_index(self):
+        self._graph_index = None
+
     @property
     def filepath(self):
         fn = self.full_filepath.replace(DAGS_FOLDER + '/', '')
@@ -1458,21 +3044,70 @@ class DAG(object):
     def get_template_env(self):
         '''
         Returns a jinja2 Environment while taking into account the DAGs
-        template_searchpath and user_defined_macros
+        template_searchpath and user_defined_macros. The environment is
+        built once and kept along with the templates it compiled, it gets
+        rebuilt when the search path or the macros are replaced.
         '''
         searchpath = [self.folder]
         if self.template_searchpath:
             searchpath += self.template_searchpath
-
+        key = (tuple(searchpath), id(self.user_defined_macros))
+        if (getattr(self, 'template_env', None) is not None and
+                self.template_env_key == key):
+            return self.template_env
+
+        cache_size = conf.getint('core', 'TEMPLATE_CACHE_SIZE')
+        # Templates loaded from files are cached by jinja and reloaded
+        # when their modification time changes
         env = jinja2.Environment(
             loader=jinja2.FileSystemLoader(searchpath),
             extensions=["jinja2.ext.do"],
-            cache_size=0)
+            cache_size=cache_size)
         if self.user_defined_macros:
             env.globals.update(self.user_defined_macros)
 
+        self.template_env = env
+        self.template_env_key = key
+        self.template_cache = (
+            jinja2.utils.LRUCache(cache_size) if cache_size > 0 else None)
         return env
 
+    def get_template(self, content, from_file=False):
+        '''
+        Returns the compiled template for a template file name when
+        ``from_file`` is set, or for a template string, which compilations
+        are kept in a bounded cache keyed by the hash of the string
+        '''
+        env = self.get_template_env()
+        if from_file:
+            return env.get_template(content)
+        if self.template_cache is None:
+            return env.from_string(content)
+        if isinstance(content, unicode):
+            key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        else:
+            key = hashlib.sha1(content).hexdigest()
+        template = self.template_cache.get(key)
+        if template is None:
+            template = env.from_string(content)
+            self.template_cache[key] = template
+        return template
+
+    def get_template_source(self, name):
+        '''
+        Returns the content of a template file found in the DAG's search
+        path. The content is cached across DAG loads, and read again once
+        the file's modification time changes.
+        '''
+        env = self.get_template_env()
+        key = (tuple(env.loader.searchpath), name)
+        cached = _template_sources.get(key)
+        if cached is not None and cached[1]():
+            return cached[0]
+        source, filename, uptodate = env.loader.get_source(env, name)
+        _template_sources[key] = (source, uptodate)
+        return source
+
     def set_dependency(self, upstream_task_id, downstream_task_id):
         """
         Simple utility method to set dependency between two tasks that
@@ -1569,13 +3204,25 @@ class DAG(object):
         result = cls.__new__(cls)
         memo[id(self)] = result
         for k, v in self.__dict__.items():
-            if k not in ('user_defined_macros', 'params'):
+            if k not in ('user_defined_macros', 'params', '_graph_index') + (
+                    TEMPLATE_ENV_ATTRS):
                 setattr(result, k, copy.deepcopy(v, memo))
 
         result.user_defined_macros = self.user_defined_macros
         result.params = self.params
+        result._graph_index = None
+        for k in TEMPLATE_ENV_ATTRS:
+            setattr(result, k, None)
         return result
 
+    def __getstate__(self):
+        # The template environment holds compiled code, it gets rebuilt
+        # where the DAG is unpickled
+        state = dict(self.__dict__)
+        for k in TEMPLATE_ENV_ATTRS:
+            state[k] = None
+        return state
+
     def sub_dag(
             self, task_regex,
             include_downstream=False, include_upstream=True):
@@ -1598,6 +3245,8 @@ class DAG(object):
         # Compiling the unique list of tasks that made the cut
         tasks = list(set(regex_match + also_include))
         dag.tasks = tasks
+        dag.task_dict = dict([(t.task_id, t) for t in tasks])
+        dag.invalidate_graph_index()
         for t in dag.tasks:
             # Removing upstream/downstream references to tasks that did not
             # made the cut
@@ -1608,14 +3257,25 @@ class DAG(object):
 
         return dag
 
+    def get_task_dict(self):
+        """
+        Returns the ``task_id -> task`` mapping of the DAG, building it for
+        DAGs unpickled from before the mapping was kept on the DAG
+        """
+        if getattr(self, 'task_dict', None) is None:
+            self.task_dict = dict([(t.task_id, t) for t in self.tasks])
+        return self.task_dict
+
     def get_task(self, task_id):
-        for task in self.tasks:
-            if task.task_id == task_id:
-                return task
+        task_dict = self.get_task_dict()
+        if task_id in task_dict:
+            return task_dict[task_id]
         raise Exception("Task {task_id} not found".format(**locals()))
 
     def __cmp__(self, other):
-        blacklist = {'_sa_instance_state', 'end_date', 'last_pickled', 'tasks'}
+        blacklist = {
+            '_sa_instance_state', 'end_date', 'last_pickled', 'tasks',
+            'task_dict', '_graph_index'}.union(TEMPLATE_ENV_ATTRS)
         for k in set(self.__dict__) - blacklist:
             if self.__dict__[k] != other.__dict__[k]:
                 return -1
@@ -1673,12 +3333,14 @@ class DAG(object):
         if not task.start_date:
             task.start_date = self.start_date
 
-        if task.task_id in [t.task_id for t in self.tasks]:
+        if task.task_id in self.get_task_dict():
             raise Exception(
                 "Task id '{0}' has already been added "
                 "to the DAG ".format(task.task_id))
         else:
             self.tasks.append(task)
+            self.task_dict[task.task_id] = task
+            self.invalidate_graph_index()
             task.dag_id = self.dag_id
             task.dag = self
         self.task_count = len(self.tasks)
@@ -1837,3 +3499,56 @@ class Pool(Base):
         """
         used_slots = self.used_slots(session=session)
         return self.slots - used_slots
+
+
+class PoolSlotLedger(object):
+    """
+    Snapshot of the running and queued counts of every pool, loaded with
+    a single grouped query. Slots handed out through ``take`` are
+    accounted for until the next snapshot so that callers don't
+    oversubscribe a pool within a scheduler loop.
+    """
+    def __init__(self, session):
+        TI = TaskInstance
+        running = func.sum(case([(TI.state == State.RUNNING, 1)], else_=0))
+        queued = func.sum(case([(TI.state == State.QUEUED, 1)], else_=0))
+        qry = (
+            session
+            .query(Pool.pool, Pool.slots, running, queued)
+            .outerjoin(TI, and_(
+                TI.pool == Pool.pool,
+                TI.state.in_([State.RUNNING, State.QUEUED])))
+            .group_by(Pool.pool, Pool.slots)
+        )
+        self.slots = {}
+        self.running = {}
+        self.queued = {}
+        self.taken = {}
+        for pool, slots, running_count, queued_count in qry.all():
+            self.slots[pool] = slots or 0
+            self.running[pool] = int(running_count or 0)
+            self.queued[pool] = int(queued_count or 0)
+            self.taken[pool] = 0
+
+    def __contains__(self, pool):
+        return pool in self.slots
+
+    def used_slots(self, pool):
+        return self.running.get(pool, 0)
+
+    def queued_slots(self, pool):
+        return self.queued.get(pool, 0)
+
+    def open_slots(self, pool):
+        """
+        Returns the number of slots open in the pool, net of the slots
+        handed out since the snapshot was taken
+        """
+        return self.slots[pool] - self.running[pool] - self.taken[pool]
+
+    def take(self, pool):
+        """
+        Records that a slot of the pool was handed out
+        """
+        if pool in self.taken:
+            self.taken[pool] += 1
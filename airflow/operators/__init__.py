@@ -1,8 +1,9 @@
 '''
 Imports operators dynamically while keeping the package API clean,
-abstracting the underlying modules
+abstracting the underlying modules. A module is only imported once one of
+its operators is accessed
 '''
-from airflow.utils import import_module_attrs as _import_module_attrs
+from airflow.utils import lazy_module_attrs as _lazy_module_attrs
 
 _operators = {
     'bash_operator': ['BashOperator'],
@@ -36,4 +37,4 @@ _operators = {
     's3_file_transform_operator' : ['S3FileTransformOperator'],
     }
 
-_import_module_attrs(globals(), _operators)
+_lazy_module_attrs(__name__, _operators)
@@ -22,6 +22,15 @@ SQL_ALCHEMY_CONN = conf.get('core', 'SQL_ALCHEMY_CONN')
 if DAGS_FOLDER not in sys.path:
     sys.path.append(DAGS_FOLDER)
 
+# Setting up a statsd client if needed
+statsd = None
+if conf.get('scheduler', 'statsd_on'):
+    from statsd import StatsClient
+    statsd = StatsClient(
+        host=conf.get('scheduler', 'statsd_host'),
+        port=conf.getint('scheduler', 'statsd_port'),
+        prefix='airflow')
+
 engine_args = {}
 if 'sqlite' not in SQL_ALCHEMY_CONN:
     # Engine args not supported by sqllite
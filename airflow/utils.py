@@ -5,13 +5,20 @@ from email.mime.multipart import MIMEMultipart
 import errno
 from functools import wraps
 import imp
+import importlib
 import inspect
 import logging
 import os
 import re
+import resource
 import shutil
+import signal
 import smtplib
+import socket
+import sys
 from tempfile import mkdtemp
+import threading
+import types
 
 from contextlib import contextmanager
 
@@ -67,6 +74,32 @@ def pessimistic_connection_handling():
         cursor.close()
 
 
+class SqlStatementCounter(object):
+    """
+    Counts the SQL statements issued through a SQLAlchemy engine
+    """
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args, **kwargs):
+        self.count += 1
+
+_statement_counter = None
+
+
+def sql_statement_count():
+    """
+    Returns the number of SQL statements this process issued against the
+    metadata database since this function was first called. Take the
+    difference between two calls to measure a block of code.
+    """
+    global _statement_counter
+    if _statement_counter is None:
+        _statement_counter = SqlStatementCounter(settings.engine)
+    return _statement_counter.count
+
+
 def initdb():
     from airflow import models
     logging.info("Creating all tables")
@@ -166,6 +199,26 @@ def resetdb():
     initdb()
 
 
+def notify_scheduler():
+    """
+    Lets the scheduler know that a task instance reached a terminal state so
+    that it can wake up before its next heartbeat. The notification is a
+    UDP datagram sent to ``[scheduler] wakeup_host:wakeup_port``, delivery
+    isn't guaranteed and failures are ignored.
+    """
+    port = conf.getint('scheduler', 'wakeup_port')
+    if not port:
+        return
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(b'ti', (conf.get('scheduler', 'wakeup_host'), port))
+        finally:
+            sock.close()
+    except socket.error as e:
+        logging.debug("Couldn't notify the scheduler: {}".format(e))
+
+
 def validate_key(k, max_length=250):
     if type(k) is not str:
         raise TypeError("The key has to be a string")
@@ -380,6 +433,96 @@ def import_module_attrs(parent_module_globals, module_attrs_dict):
     return imported_attrs
 
 
+class LazyModule(types.ModuleType):
+    '''
+    Stands in for a package in ``sys.modules`` and imports the module
+    holding one of the attributes listed in ``module_attrs_dict`` the first
+    time the attribute is accessed, silencing import errors like
+    ``import_module_attrs`` does.
+
+    The modules are imported as top level modules, which is how pickled
+    DAGs refer to them, unless ``qualified`` is set in which case they are
+    imported as submodules of the package. For the former, the lazy module
+    is also an import hook that makes the top level modules importable
+    without importing the package's attributes first, say when unpickling.
+    '''
+    def __init__(self, module, module_attrs_dict, qualified=False):
+        super(LazyModule, self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        # Keeping the original module alive, its globals get cleared
+        # otherwise
+        self._module = module
+        self._module_attrs = module_attrs_dict
+        self._attr_modules = {}
+        for mod, attrs in module_attrs_dict.items():
+            for attr in attrs:
+                self._attr_modules[attr] = mod
+        self._qualified = qualified
+        self._failed = set()
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or attr not in self._attr_modules:
+            raise AttributeError(attr)
+        self._load(self._attr_modules[attr])
+        if attr not in self.__dict__:
+            raise AttributeError(attr)
+        return self.__dict__[attr]
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self._attr_modules))
+
+    @property
+    def __all__(self):
+        for mod in self._module_attrs:
+            self._load(mod)
+        return sorted([
+            attr for attr in self._attr_modules if attr in self.__dict__])
+
+    def _load(self, mod):
+        if mod in self._failed:
+            return
+        try:
+            if self._qualified:
+                module = importlib.import_module(self.__name__ + '.' + mod)
+            else:
+                module = self.load_module(mod)
+            for attr in self._module_attrs[mod]:
+                setattr(self, attr, getattr(module, attr))
+        except:
+            logging.warning("Couldn't import module " + mod)
+            self._failed.add(mod)
+
+    def find_module(self, fullname, path=None):
+        if not self._qualified and path is None and (
+                fullname in self._module_attrs):
+            return self
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        folder = os.path.dirname(self.__file__)
+        f, filename, description = imp.find_module(fullname, [folder])
+        try:
+            return imp.load_module(fullname, f, filename, description)
+        finally:
+            if f:
+                f.close()
+
+
+def lazy_module_attrs(module_name, module_attrs_dict, qualified=False):
+    '''
+    Lazy counterpart of ``import_module_attrs``, replaces the module in
+    ``sys.modules`` with a LazyModule. It has to be called at the end of
+    the package's ``__init__``.
+    '''
+    lazy_module = LazyModule(
+        sys.modules[module_name], module_attrs_dict, qualified)
+    sys.modules[module_name] = lazy_module
+    if not qualified:
+        sys.meta_path.append(lazy_module)
+    return lazy_module
+
+
 def is_in(obj, l):
     """
     Checks whether an object is one of the item in the list.
@@ -392,6 +535,200 @@ def is_in(obj, l):
     return False
 
 
+class AirflowTimeout(Exception):
+    pass
+
+
+@contextmanager
+def timeout(seconds, error_message="Timeout"):
+    """
+    Raises an AirflowTimeout in the block it wraps when it runs for longer
+    than ``seconds``. It relies on SIGALRM, so it only applies in the main
+    thread and is a no-op elsewhere or when ``seconds`` isn't positive.
+    """
+    if (
+            not seconds or seconds <= 0 or
+            not isinstance(threading.current_thread(), threading._MainThread)):
+        yield
+        return
+
+    def handle_timeout(signum, frame):
+        raise AirflowTimeout(error_message)
+
+    previous_handler = signal.signal(signal.SIGALRM, handle_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+class ProcessTreeSampler(object):
+    """
+    Samples the resource usage of a process and its descendants from
+    ``/proc``. Counters are kept per process, as last sampled, so that the
+    processes that exit between two samples keep being accounted for. On
+    systems without ``/proc`` sampling is a no-op.
+
+    The descendants are found by following the ``children`` files of the
+    threads of each process of the tree. Kernels that don't provide those
+    have the parent of every process of the host read instead, which is
+    only done every ``scan_every`` samples, the samples in between reuse
+    the pids found by the last scan.
+
+    :param pid: the process at the root of the tree
+    :type pid: int
+    :param scan_every: how many samples reuse the pids found by scanning
+        all the processes, when the ``children`` files aren't available
+    :type scan_every: int
+    """
+    PROC = '/proc'
+
+    def __init__(self, pid, scan_every=30):
+        self.pid = pid
+        self.scan_every = scan_every
+        self.clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        self.processes = {}
+        self.peak_rss_kb = 0
+        self.samples = 0
+        self.scanned_start_times = {}
+        # The main thread of a process has the process' pid as thread id
+        self.has_children_files = os.path.isfile(os.path.join(
+            self.PROC, str(os.getpid()), 'task', str(os.getpid()),
+            'children'))
+
+    def tree(self):
+        """
+        Returns the pids of the process and its descendants
+        """
+        if self.has_children_files:
+            pids = [self.pid]
+            for pid in pids:
+                pids += self.read_children(pid)
+            return pids
+        if self.samples % self.scan_every == 0:
+            self.scanned_start_times = self.scan_tree()
+        return list(self.scanned_start_times)
+
+    def read_children(self, pid):
+        task_folder = os.path.join(self.PROC, str(pid), 'task')
+        children = []
+        try:
+            for tid in os.listdir(task_folder):
+                with open(os.path.join(task_folder, tid, 'children')) as f:
+                    children += [int(child) for child in f.read().split()]
+        except (IOError, OSError):
+            pass  # The process or one of its threads exited
+        return children
+
+    def scan_tree(self):
+        """
+        Reads every process of the host to find the descendants of the
+        process, returns their start times by pid
+        """
+        children = {}
+        start_times = {}
+        for name in os.listdir(self.PROC):
+            if not name.isdigit():
+                continue
+            stat = self.read_stat(name)
+            if stat:
+                children.setdefault(int(stat[1]), []).append(int(name))
+                start_times[int(name)] = stat[19]
+        pids = [self.pid]
+        for pid in pids:
+            pids += children.get(pid, [])
+        return dict([(pid, start_times.get(pid)) for pid in pids])
+
+    def read_stat(self, pid):
+        try:
+            with open(os.path.join(self.PROC, str(pid), 'stat')) as f:
+                content = f.read()
+        except (IOError, OSError):
+            return None
+        # The command name is in parentheses and may contain spaces, the
+        # fields following it start with the state
+        return content[content.rfind(')') + 2:].split()
+
+    def read_fields(self, pid, filename, sep=':'):
+        fields = {}
+        try:
+            with open(os.path.join(self.PROC, str(pid), filename)) as f:
+                for line in f:
+                    key, _, value = line.partition(sep)
+                    fields[key.strip()] = value.strip().split(' ')[0]
+        except (IOError, OSError):
+            pass
+        return fields
+
+    def sample(self):
+        if not os.path.isdir(self.PROC):
+            return
+        rss_kb = 0
+        for pid in self.tree():
+            stat = self.read_stat(pid)
+            if not stat:
+                continue
+            start_time = self.scanned_start_times.get(pid)
+            if start_time and start_time != stat[19]:
+                continue  # Reused by another process since the last scan
+            status = self.read_fields(pid, 'status')
+            io = self.read_fields(pid, 'io')
+            rss_kb += int(status.get('VmRSS', 0))
+            # Keyed along with the start time as pids get reused
+            self.processes[(pid, stat[19])] = {
+                'cpu_user_time': int(stat[11]) / self.clock_ticks,
+                'cpu_system_time': int(stat[12]) / self.clock_ticks,
+                'max_rss_kb': int(status.get('VmHWM', 0)),
+                'read_bytes': int(io.get('read_bytes', 0)),
+                'write_bytes': int(io.get('write_bytes', 0)),
+                'context_switches': (
+                    int(status.get('voluntary_ctxt_switches', 0)) +
+                    int(status.get('nonvoluntary_ctxt_switches', 0))),
+            }
+        self.peak_rss_kb = max(self.peak_rss_kb, rss_kb)
+        self.samples += 1
+
+    def usage(self):
+        """
+        Returns the CPU times in seconds, the peak resident set size in
+        kilobytes, the bytes read and written and the number of context
+        switches of the tree, as sampled
+        """
+        usage = {
+            'cpu_user_time': 0.0,
+            'cpu_system_time': 0.0,
+            'read_bytes': 0,
+            'write_bytes': 0,
+            'context_switches': 0,
+        }
+        for counters in self.processes.values():
+            for k in usage:
+                usage[k] += counters[k]
+        usage['max_rss_kb'] = max([self.peak_rss_kb] + [
+            c['max_rss_kb'] for c in self.processes.values()])
+        return usage
+
+
+def children_rusage():
+    """
+    Returns the CPU times, peak resident set size and number of context
+    switches of the child processes that were waited for, as reported by
+    ``getrusage``, in the units ``ProcessTreeSampler.usage`` uses
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    max_rss_kb = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss_kb //= 1024
+    return {
+        'cpu_user_time': usage.ru_utime,
+        'cpu_system_time': usage.ru_stime,
+        'max_rss_kb': max_rss_kb,
+        'context_switches': usage.ru_nvcsw + usage.ru_nivcsw,
+    }
+
+
 @contextmanager
 def TemporaryDirectory(suffix='', prefix=None, dir=None):
     name = mkdtemp(suffix=suffix, prefix=prefix, dir=dir)
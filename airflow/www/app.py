@@ -108,7 +108,11 @@ special_attrs = {
 }
 
 
-dagbag = models.DagBag(os.path.expanduser(conf.get('core', 'DAGS_FOLDER')))
+if conf.getboolean('core', 'STORE_SERIALIZED_DAGS'):
+    dagbag = models.SerializedDagBag()
+else:
+    dagbag = models.DagBag(
+        os.path.expanduser(conf.get('core', 'DAGS_FOLDER')))
 utils.pessimistic_connection_handling()
 
 app = Flask(__name__)
@@ -229,6 +233,25 @@ class DagModelView(SuperUserMixin, ModelView):
         )
 
 
+def operator_legend(dag):
+    """
+    Returns the operators of the DAG's tasks with their colors, sorted by
+    name. Works off the tasks' attributes as the tasks of serialized DAGs
+    aren't instances of their operator class
+    """
+    operators = {}
+    for task in dag.tasks:
+        name = task.__class__.__name__
+        if name == 'BaseOperator':
+            name = task.task_type or name
+        operators[name] = {
+            'name': name,
+            'ui_color': task.ui_color,
+            'ui_fgcolor': task.ui_fgcolor,
+        }
+    return [operators[name] for name in sorted(operators)]
+
+
 class HomeView(AdminIndexView):
     @expose("/")
     @login_required
@@ -616,7 +639,9 @@ class Airflow(BaseView):
     def code(self):
         dag_id = request.args.get('dag_id')
         dag = dagbag.get_dag(dag_id)
-        code = "".join(open(dag.full_filepath, 'r').readlines())
+        code = getattr(dag, 'source_code', None)
+        if code is None:
+            code = "".join(open(dag.full_filepath, 'r').readlines())
         title = dag.filepath
         html_code = highlight(
             code, PythonLexer(), HtmlFormatter(linenos=True))
@@ -689,7 +714,7 @@ class Airflow(BaseView):
             flash("Error rendering template: " + str(e), "error")
         title = "Rendered Template"
         html_dict = {}
-        for template_field in task.__class__.template_fields:
+        for template_field in task.template_fields:
             content = getattr(task, template_field)
             if template_field in special_attrs:
                 html_dict[template_field] = highlight(
@@ -1032,10 +1057,7 @@ class Airflow(BaseView):
 
         return self.render(
             'airflow/tree.html',
-            operators=sorted(
-                list(set([op.__class__ for op in dag.tasks])),
-                key=lambda x: x.__name__
-            ),
+            operators=operator_legend(dag),
             root=root,
             dag=dag, data=data, blur=blur)
 
@@ -1047,7 +1069,7 @@ class Airflow(BaseView):
         blur = request.args.get('blur') == 'true'
         arrange = request.args.get('arrange', "LR")
         dag = dagbag.get_dag(dag_id)
-        if dag_id not in dagbag.dags:
+        if not dag:
             flash('DAG "{0}" seems to be missing.'.format(dag_id), "error")
             return redirect('/admin/dagmodel/')
 
@@ -1110,10 +1132,7 @@ class Airflow(BaseView):
             form=form,
             execution_date=dttm.isoformat(),
             arrange=arrange,
-            operators=sorted(
-                list(set([op.__class__ for op in dag.tasks])),
-                key=lambda x: x.__name__
-            ),
+            operators=operator_legend(dag),
             blur=blur,
             root=root or '',
             task_instances=json.dumps(task_instances, indent=2),
@@ -1203,6 +1222,7 @@ class Airflow(BaseView):
         session.commit()
         session.close()
 
+        dagbag.expire_snapshot()
         dagbag.get_dag(dag_id)
         flash("DAG [{}] is now fresh as a daisy".format(dag_id))
         return redirect('/admin/dagmodel/')
@@ -1446,6 +1466,27 @@ def nobr_f(v, c, m, p):
     return Markup("<nobr>{}</nobr>".format(getattr(m, p)))
 
 
+def bytes_f(v, c, m, p):
+    size = getattr(m, p)
+    if p.endswith('_kb') and size is not None:
+        size *= 1024
+    if size is None:
+        return ''
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TB'
+    return Markup("<nobr>{:.4g} {}</nobr>".format(size, unit))
+
+
+def seconds_f(v, c, m, p):
+    seconds = getattr(m, p)
+    if seconds is not None:
+        return "{:.2f}s".format(seconds)
+
+
 class JobModelView(ModelViewOnly):
     column_default_sort = ('start_date', True)
     column_filters = (
@@ -1474,13 +1515,20 @@ class TaskInstanceModelView(ModelViewOnly):
         execution_date=datetime_f,
         start_date=datetime_f,
         end_date=datetime_f,
-        dag_id=dag_link, duration=duration_f)
+        dag_id=dag_link, duration=duration_f,
+        cpu_user_time=seconds_f, cpu_system_time=seconds_f,
+        max_rss_kb=bytes_f, read_bytes=bytes_f, write_bytes=bytes_f)
     column_searchable_list = ('dag_id', 'task_id', 'state')
     column_default_sort = ('start_date', True)
     column_list = (
         'dag_id', 'task_id', 'execution_date',
         'start_date', 'end_date', 'duration', 'state', 'job_id', 'hostname',
-        'unixname', 'log')
+        'unixname', 'cpu_user_time', 'cpu_system_time', 'max_rss_kb',
+        'read_bytes', 'write_bytes', 'context_switches', 'log')
+    column_labels = dict(
+        cpu_user_time='CPU user', cpu_system_time='CPU sys',
+        max_rss_kb='Peak RSS', read_bytes='Read', write_bytes='Written',
+        context_switches='Ctx switches')
     can_delete = True
     page_size = 100
 mv = TaskInstanceModelView(
@@ -1729,7 +1777,8 @@ def fused_slots(v, c, m, p):
         '/admin/taskinstance/' +
         '?flt1_pool_equals=' + m.pool +
         '&flt2_state_equals=running')
-    return Markup("<a href='{0}'>{1}</a>".format(url, m.used_slots()))
+    return Markup("<a href='{0}'>{1}</a>".format(
+        url, v.slot_ledger.used_slots(m.pool)))
 
 
 def fqueued_slots(v, c, m, p):
@@ -1737,12 +1786,18 @@ def fqueued_slots(v, c, m, p):
         '/admin/taskinstance/' +
         '?flt1_pool_equals=' + m.pool +
         '&flt2_state_equals=queued')
-    return Markup("<a href='{0}'>{1}</a>".format(url, m.queued_slots()))
+    return Markup("<a href='{0}'>{1}</a>".format(
+        url, v.slot_ledger.queued_slots(m.pool)))
 
 class PoolModelView(SuperUserMixin, ModelView):
     column_list = ('pool', 'slots', 'used_slots', 'queued_slots')
     column_formatters = dict(
         pool=pool_link, used_slots=fused_slots, queued_slots=fqueued_slots)
     named_filter_urls = True
+
+    def get_list(self, *args, **kwargs):
+        # Loading the slot counts of all pools at once for the formatters
+        self.slot_ledger = models.PoolSlotLedger(self.session)
+        return super(PoolModelView, self).get_list(*args, **kwargs)
 mv = PoolModelView(models.Pool, Session, name="Pools", category="Admin")
 admin.add_view(mv)
@@ -0,0 +1,142 @@
+"""
+Import time benchmark.
+
+Measures, each in a fresh interpreter and over a number of repetitions,
+how long ``import airflow``, ``import airflow.operators`` and the import of
+typical DAG files take, along with the third party libraries each of them
+pulls in, and writes the results to a JSON file so that they can be
+compared across versions.
+
+    python benchmarks/import_benchmark.py --repeat 5 \\
+        --dag_file airflow/example_dags/example_bash_operator.py \\
+        --output results.json
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Libraries some hooks, operators or executors depend on, that a process
+# should only import when it uses them
+HEAVY_MODULES = [
+    'boto', 'celery', 'hive_service', 'MySQLdb', 'psycopg2', 'pyhive',
+    'pyhs2', 'pandas', 'smbclient', 'snakebite', 'thrift',
+]
+
+STATEMENTS = {
+    'import airflow': 'import airflow',
+    'import airflow.operators': 'import airflow.operators',
+    'import airflow.models': 'from airflow import models',
+}
+
+MEASURE_TEMPLATE = '''\
+import json
+import sys
+import time
+start = time.time()
+{statement}
+duration = time.time() - start
+json.dump({{
+    'duration': duration,
+    'modules': len(sys.modules),
+    'heavy_modules': sorted([
+        m for m in {heavy_modules!r} if sys.modules.get(m) is not None]),
+}}, sys.stdout)
+'''
+
+
+def dag_file_statement(filepath):
+    return "import imp; imp.load_source('benchmarked_dag', {!r})".format(
+        os.path.abspath(filepath))
+
+
+def measure(statement, env):
+    """
+    Runs the statement in a fresh interpreter and returns its measures
+    """
+    script = MEASURE_TEMPLATE.format(
+        statement=statement, heavy_modules=HEAVY_MODULES)
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], env=env, stderr=devnull)
+    return json.loads(output)
+
+
+def summarize(runs):
+    durations = sorted([run['duration'] for run in runs])
+    return {
+        'runs': len(runs),
+        'duration_min': durations[0],
+        'duration_median': durations[len(durations) // 2],
+        'duration_max': durations[-1],
+        'modules': runs[-1]['modules'],
+        'heavy_modules': runs[-1]['heavy_modules'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help="Number of fresh interpreters each import is measured in")
+    parser.add_argument(
+        '--dag_file', action='append', default=[],
+        help=(
+            "DAG file to measure the import of, can be repeated. Defaults "
+            "to the example DAGs"))
+    parser.add_argument(
+        '--output', default='import_benchmark.json',
+        help="Path of the JSON file the results are written to")
+    args = parser.parse_args()
+
+    dag_files = args.dag_file or [
+        os.path.join(REPO_ROOT, 'airflow', 'example_dags', f)
+        for f in sorted(os.listdir(
+            os.path.join(REPO_ROOT, 'airflow', 'example_dags')))
+        if f.endswith('.py') and f != '__init__.py']
+    statements = dict(STATEMENTS)
+    for filepath in dag_files:
+        statements['import ' + os.path.basename(filepath)] = (
+            dag_file_statement(filepath))
+
+    tmp_dir = tempfile.mkdtemp(prefix='airflow_benchmark_')
+    # A throwaway AIRFLOW_HOME, as importing airflow writes its config
+    os.environ['AIRFLOW_HOME'] = tmp_dir
+    os.environ['AIRFLOW_CONFIG'] = os.path.join(tmp_dir, 'airflow.cfg')
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [REPO_ROOT, env.get('PYTHONPATH')]))
+    sys.path.insert(0, REPO_ROOT)
+    try:
+        # Creating the config and compiling the modules once upfront
+        measure('import airflow', env)
+        results = {}
+        for name, statement in sorted(statements.items()):
+            runs = [measure(statement, env) for i in range(args.repeat)]
+            results[name] = summarize(runs)
+            print("{}: {:.3f}s, {} modules, heavy modules: {}".format(
+                name, results[name]['duration_median'],
+                results[name]['modules'],
+                ', '.join(results[name]['heavy_modules']) or 'none'))
+        from airflow import __version__
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'airflow_version': __version__,
+            'python_version': sys.version.split()[0],
+            'timestamp': datetime.now().isoformat(),
+            'results': results,
+        }, f, indent=4, sort_keys=True)
+    print("Results written to " + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,3 +3,23 @@ alter table task_instance add column queue varchar(50) NULL;
 alter table task_instance add column pool varchar(50) NULL;
 alter table task_instance add column priority_weight INT NULL;
 create index ti_pool on task_instance (pool, state) using btree;
+
+// To 0.7.1
+alter table task_instance add column updated_at datetime NULL;
+create index ti_updated_at on task_instance (updated_at) using btree;
+create table serialized_dag (
+    dag_id varchar(250) NOT NULL,
+    fileloc varchar(2000) NULL,
+    dag_hash varchar(40) NULL,
+    data longtext NULL,
+    source_code longtext NULL,
+    last_updated datetime NULL,
+    PRIMARY KEY (dag_id)
+);
+alter table task_instance modify duration float NULL;
+alter table task_instance add column cpu_user_time float NULL;
+alter table task_instance add column cpu_system_time float NULL;
+alter table task_instance add column max_rss_kb INT NULL;
+alter table task_instance add column read_bytes BIGINT NULL;
+alter table task_instance add column write_bytes BIGINT NULL;
+alter table task_instance add column context_switches INT NULL;
@@ -1,8 +1,19 @@
-from datetime import datetime, time
+import copy
+from datetime import datetime, time, timedelta
+import dill
+import imp
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from time import sleep
 import unittest
+from sqlalchemy.exc import IntegrityError
 from airflow import configuration
 configuration.test_mode()
-from airflow import jobs, models, DAG, executors, utils, operators
+from airflow import jobs, models, DAG, executors, utils, operators, settings
+from airflow.executors.base_executor import BaseExecutor
 from airflow.www.app import app
 
 NUM_EXAMPLE_DAGS = 3
@@ -167,11 +178,842 @@ class CoreTest(unittest.TestCase):
             task=self.runme_0, execution_date=DEFAULT_DATE)
         job = jobs.LocalTaskJob(task_instance=ti, force=True)
         job.run()
+        session = settings.Session()
+        ti = session.query(TI).filter(
+            TI.dag_id == ti.dag_id, TI.task_id == ti.task_id,
+            TI.execution_date == DEFAULT_DATE).first()
+        session.close()
+        assert ti.job_id == job.id
+        assert ti.cpu_user_time > 0
+        assert ti.context_switches > 0
+        assert isinstance(ti.duration, float)
+
+    def test_process_tree_sampler(self):
+        process = subprocess.Popen(
+            ['bash', '-c', 'sleep 5 | cat'], stdout=subprocess.PIPE)
+        sampler = utils.ProcessTreeSampler(process.pid, scan_every=1)
+        for i in range(50):
+            sampler.sample()
+            # bash, sleep and cat
+            if len(sampler.processes) == 3:
+                break
+            sleep(0.1)
+        process.kill()
+        process.wait()
+        if os.path.isdir('/proc'):
+            assert len(sampler.processes) == 3
+            assert sampler.usage()['max_rss_kb'] > 0
+
+        def add_process(pid, ppid, children=None, start_time=1):
+            os.makedirs(os.path.join(proc, str(pid), 'task', str(pid)))
+            with open(os.path.join(proc, str(pid), 'stat'), 'w') as f:
+                f.write('{} (sh) S {} {} {}'.format(
+                    pid, ppid, ' '.join(['0'] * 17), start_time))
+            if children is not None:
+                path = os.path.join(proc, str(pid), 'task', str(pid))
+                with open(os.path.join(path, 'children'), 'w') as f:
+                    f.write(' '.join([str(child) for child in children]))
+
+        proc = tempfile.mkdtemp()
+        try:
+            # The tree is read out of the children files when there are some
+            add_process(10, 1, children=[11])
+            add_process(11, 10, children=[])
+            add_process(12, 1, children=[])
+            sampler = utils.ProcessTreeSampler(10)
+            sampler.PROC = proc
+            sampler.has_children_files = True
+            assert sampler.tree() == [10, 11]
+        finally:
+            shutil.rmtree(proc)
+
+        proc = tempfile.mkdtemp()
+        try:
+            # Otherwise every process is read, once every scan_every samples
+            add_process(10, 1)
+            add_process(11, 10)
+            add_process(12, 1)
+            sampler = utils.ProcessTreeSampler(10, scan_every=3)
+            sampler.PROC = proc
+            sampler.has_children_files = False
+            sampler.sample()
+            assert sorted(sampler.processes) == [(10, '1'), (11, '1')]
+            add_process(13, 10)
+            sampler.sample()
+            sampler.sample()
+            assert (13, '1') not in sampler.processes
+            sampler.sample()
+            assert (13, '1') in sampler.processes
+            # Pids reused since the last scan aren't sampled
+            shutil.rmtree(os.path.join(proc, '11'))
+            add_process(11, 1, start_time=2)
+            sampler.sample()
+            assert (11, '2') not in sampler.processes
+        finally:
+            shutil.rmtree(proc)
 
     def test_scheduler_job(self):
         job = jobs.SchedulerJob(dag_id='example_bash_operator', test_mode=True)
         job.run()
 
+    def test_scheduler_loop_stats(self):
+        class FakeStatsClient(object):
+            def __init__(self):
+                self.timings = {}
+                self.gauges = {}
+                self.counters = []
+
+            def timing(self, stat, ms):
+                self.timings[stat] = ms
+
+            def gauge(self, stat, value, rate=1):
+                self.gauges[stat] = value
+
+            def incr(self, stat, count=1, rate=1):
+                self.counters.append(stat)
+
+        class NoopExecutor(BaseExecutor):
+            def execute_async(self, key, command, queue=None):
+                pass
+
+            def end(self):
+                pass
+
+        stats = FakeStatsClient()
+        statsd = jobs.statsd
+        jobs.statsd = stats
+        try:
+            job = jobs.SchedulerJob(
+                dag_id='example_bash_operator', test_mode=True,
+                executor=NoopExecutor())
+            job.heartrate = 0
+            job.run()
+        finally:
+            jobs.statsd = statsd
+
+        for phase in (
+                'state_index_sync', 'prioritize_queued', 'dagbag_refresh',
+                'process_dag.example_bash_operator', 'executor_heartbeat'):
+            assert 'scheduler.' + phase in stats.timings
+            assert 'scheduler.' + phase + '.statements' in stats.gauges
+            assert phase in job.loop_stats
+        assert stats.timings['scheduler.loop'] >= 0
+        assert stats.gauges['scheduler.loop.statements'] > 0
+        assert stats.gauges['scheduler.queued_tis'] >= 0
+        assert 'schedulerjob_start' in stats.counters
+
+    def test_batched_dependencies(self):
+        TI = models.TaskInstance
+        session = settings.Session()
+        dates = [DEFAULT_DATE, DEFAULT_DATE - self.dag_bash.schedule_interval]
+        ti_states = TI.get_dag_ti_states(
+            self.dag_bash.dag_id, dates, session)
+        session.close()
+        for task in self.dag_bash.tasks:
+            ti = TI(task=task, execution_date=DEFAULT_DATE)
+            ti.refresh_from_db()
+            assert ti.is_queueable() == ti.is_queueable(ti_states=ti_states)
+            assert (
+                ti.are_dependencies_met() ==
+                ti.are_dependencies_met(ti_states=ti_states))
+
+    def test_task_state_index(self):
+        TI = models.TaskInstance
+        ti = TI(task=self.runme_0, execution_date=DEFAULT_DATE)
+        ti.run(force=True)
+        session = settings.Session()
+        index = jobs.TaskStateIndex()
+        index.full_sync(session)
+        latest = index.latest_for_dag(self.dag_bash.dag_id)
+        assert latest['runme_0'].state == utils.State.SUCCESS
+
+        ti = session.merge(ti)
+        ti.state = utils.State.QUEUED
+        session.commit()
+        index.sync(session)
+        assert ti.key in [t.key for t in index.queued()]
+
+        DM = models.DagModel
+        orm_dag = session.merge(DM(dag_id=self.dag_bash.dag_id))
+        orm_dag.is_paused = True
+        session.commit()
+        index.sync(session)
+        assert self.dag_bash.dag_id in index.paused_dag_ids
+        orm_dag = session.merge(orm_dag)
+        orm_dag.is_paused = False
+        session.commit()
+        index.sync(session)
+        assert self.dag_bash.dag_id not in index.paused_dag_ids
+        session.close()
+
+    def test_dag_lock(self):
+        lock = jobs.DagLock('tutorial')
+        assert lock.acquire()
+        assert not jobs.DagLock('tutorial').acquire()
+        lock.release()
+        lock = jobs.DagLock('tutorial')
+        assert lock.acquire()
+        lock.release()
+
+    def test_dag_lock_skip_locked_support(self):
+        class FakeDialect(object):
+            def __init__(self, name, server_version_info):
+                self.name = name
+                self.server_version_info = server_version_info
+
+        supports = jobs.DagLock.supports_skip_locked
+        assert supports(FakeDialect('postgresql', (9, 5, 3)))
+        assert not supports(FakeDialect('postgresql', (9, 4, 1)))
+        assert supports(FakeDialect('mysql', (8, 0, 1)))
+        assert not supports(FakeDialect('mysql', (5, 7, 22)))
+        assert not supports(FakeDialect('mysql', (10, 3, 22, 'MariaDB')))
+        assert not supports(
+            FakeDialect('mysql', (5, 5, 5, 10, 5, 9, 'MariaDB')))
+        assert supports(FakeDialect('mysql', (10, 6, 4, 'MariaDB')))
+        assert supports(
+            FakeDialect('mysql', (5, 5, 5, 10, 11, 2, 'MariaDB')))
+        assert not supports(FakeDialect('sqlite', (3, 31, 1)))
+
+    def test_dag_graph_index(self):
+        def walk(task, upstream):
+            task_ids = set()
+            for t in task.get_direct_relatives(upstream):
+                task_ids.add(t.task_id)
+                task_ids |= walk(t, upstream)
+            return task_ids
+
+        for dag in self.dagbag.dags.values():
+            index = dag.graph_index
+            order = index.topological_order
+            assert sorted(order) == sorted(dag.task_ids)
+            for task in dag.tasks:
+                relatives = task.get_flat_relatives(upstream=False)
+                assert [t.task_id for t in relatives] == [
+                    task_id for task_id in order
+                    if task_id in walk(task, upstream=False)]
+                assert set([
+                    t.task_id
+                    for t in task.get_flat_relatives(upstream=True)
+                ]) == walk(task, upstream=True)
+                assert task.priority_weight_total == sum(
+                    [t.priority_weight for t in relatives] +
+                    [task.priority_weight])
+                for t in task.downstream_list:
+                    assert order.index(task.task_id) < order.index(t.task_id)
+
+        args = {'owner': 'airflow', 'start_date': DEFAULT_DATE}
+        dag = models.DAG('graph_index_test', default_args=args)
+        t1 = operators.DummyOperator(task_id='t1', dag=dag)
+        t2 = operators.DummyOperator(task_id='t2', dag=dag)
+        assert dag.graph_index.priority_weight_total['t1'] == 1
+        t1.set_downstream(t2)
+        assert t1.priority_weight_total == 2
+        assert dag.get_task('t2') is t2
+
+        # DAGs pickled before the task_dict was kept on the DAG
+        del dag.__dict__['task_dict']
+        del dag.__dict__['_graph_index']
+        dag = dill.loads(dill.dumps(dag))
+        assert dag.get_task('t2').task_id == 't2'
+        assert dag.get_task('t1').priority_weight_total == 2
+
+    def test_pool_slot_ledger(self):
+        session = settings.Session()
+        pool = models.Pool(pool='test_pool_slot_ledger', slots=2)
+        session.add(pool)
+        session.commit()
+        ledger = models.PoolSlotLedger(session)
+        assert ledger.used_slots(pool.pool) == pool.used_slots()
+        assert ledger.queued_slots(pool.pool) == pool.queued_slots()
+        assert ledger.open_slots(pool.pool) == 2
+        ledger.take(pool.pool)
+        assert ledger.open_slots(pool.pool) == 1
+        assert 'no_such_pool' not in ledger
+        session.delete(pool)
+        session.commit()
+        session.close()
+
+    def test_check_readiness(self):
+        args = {'owner': 'airflow', 'start_date': DEFAULT_DATE}
+        dag = models.DAG(
+            'check_readiness_test', default_args=args,
+            schedule_interval=timedelta(days=1))
+        t1 = operators.DummyOperator(task_id='t1', dag=dag)
+        t2 = operators.DummyOperator(
+            task_id='t2', depends_on_past=True, dag=dag)
+        t1.set_downstream(t2)
+        TI = models.TaskInstance
+        session = settings.Session()
+        done = TI(t1, DEFAULT_DATE)
+        done.state = utils.State.SUCCESS
+        session.merge(done)
+        session.commit()
+        session.close()
+
+        tis = [
+            TI(task, DEFAULT_DATE + timedelta(days=i))
+            for i in range(10) for task in (t1, t2)]
+        start = utils.sql_statement_count()
+        verdicts = TI.check_readiness(tis)
+        # The task instances and the pools, whatever the size of the batch
+        assert utils.sql_statement_count() - start <= 2
+        assert len(verdicts) == 20
+        ready, reason = verdicts[(dag.dag_id, 't1', DEFAULT_DATE)]
+        assert not ready and 'success' in reason
+        assert verdicts[(dag.dag_id, 't2', DEFAULT_DATE)] == (True, None)
+        ready, reason = verdicts[
+            (dag.dag_id, 't2', DEFAULT_DATE + timedelta(days=1))]
+        assert not ready and 'depends_on_past' in reason
+        assert verdicts[
+            (dag.dag_id, 't1', DEFAULT_DATE + timedelta(days=1))] == (
+                True, None)
+        for ti in tis:
+            assert verdicts[ti.key][0] == ti.is_runnable()
+
+    def test_state_compare_and_set(self):
+        args = {'owner': 'airflow', 'start_date': DEFAULT_DATE}
+        dag = models.DAG('compare_and_set_test', default_args=args)
+        task = operators.DummyOperator(task_id='dummy', dag=dag)
+        TI = models.TaskInstance
+        Log = models.Log
+        session = settings.Session()
+
+        ti = TI(task, DEFAULT_DATE)
+        start = utils.sql_statement_count()
+        ti.run(force=True)
+        # A read, the update that finds no row and the insert as running,
+        # the update as success, each transition with its log
+        assert utils.sql_statement_count() - start <= 6
+        ti.refresh_from_db()
+        assert ti.state == utils.State.SUCCESS
+        events = [l.event for l in session.query(Log).filter(
+            Log.dag_id == dag.dag_id)]
+        assert events == [utils.State.RUNNING, utils.State.SUCCESS]
+
+        # The task instance gets started by another process while this one
+        # is checking its dependencies
+        ti = TI(task, DEFAULT_DATE + timedelta(days=1))
+
+        def started_elsewhere(main_session=None):
+            other = TI(task, ti.execution_date, state=utils.State.RUNNING)
+            assert other.compare_and_set(session, None, 1)
+            return True
+        ti.are_dependencies_met = started_elsewhere
+        ti.run()
+        ti.refresh_from_db()
+        assert ti.state == utils.State.RUNNING
+        assert not TI(task, ti.execution_date).compare_and_set(
+            session, None, 1)
+        assert not TI(task, ti.execution_date).compare_and_set(
+            session, utils.State.RUNNING, 2)
+        session.query(Log).filter(Log.dag_id == dag.dag_id).delete()
+        session.query(TI).filter(TI.dag_id == dag.dag_id).delete()
+        session.commit()
+        session.close()
+
+    def test_template_cache(self):
+        folder = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(folder, 'cached.sh')
+            with open(filepath, 'w') as f:
+                f.write('echo {{ ds }}')
+            dag = models.DAG(
+                'template_cache_test', template_searchpath=folder,
+                default_args={'owner': 'airflow', 'start_date': DEFAULT_DATE})
+            task = operators.BashOperator(
+                task_id='cached', bash_command='cached.sh', dag=dag)
+            env = dag.get_template_env()
+            assert dag.get_template_env() is env
+            template = dag.get_template('echo {{ ds }}')
+            assert dag.get_template(u'echo {{ ds }}') is template
+            assert dag.get_template('cached.sh', from_file=True) is \
+                dag.get_template('cached.sh', from_file=True)
+
+            ti = models.TaskInstance(task=task, execution_date=DEFAULT_DATE)
+            ti.render_templates()
+            assert task.bash_command == 'echo 2015-01-01'
+
+            assert dag.get_template_source('cached.sh') == 'echo {{ ds }}'
+            with open(filepath, 'w') as f:
+                f.write('echo {{ ds_nodash }}')
+            os.utime(filepath, (0, 0))
+            assert dag.get_template_source('cached.sh') == (
+                'echo {{ ds_nodash }}')
+
+            assert copy.deepcopy(dag).template_env is None
+            assert dill.loads(dill.dumps(dag)).template_env is None
+            dag.template_searchpath = [folder, tempfile.gettempdir()]
+            assert dag.get_template_env() is not env
+        finally:
+            shutil.rmtree(folder)
+
+    def test_event_log_sinks(self):
+        args = {'owner': 'airflow', 'start_date': DEFAULT_DATE}
+        dag = models.DAG('event_log_sink_test', default_args=args)
+        task = operators.DummyOperator(task_id='dummy', dag=dag)
+        ti = models.TaskInstance(task, DEFAULT_DATE)
+        Log = models.Log
+        session = settings.Session()
+
+        def events():
+            return [l.event for l in session.query(Log).filter(
+                Log.dag_id == dag.dag_id).order_by(Log.id)]
+
+        sink = models.BufferedEventLogSink(flush_interval=0)
+        sink.record(Log(utils.State.RUNNING, ti))
+        sink.record(Log(utils.State.SUCCESS, ti))
+        assert events() == []
+        start = utils.sql_statement_count()
+        sink.flush()
+        # One executemany for the whole buffer
+        assert utils.sql_statement_count() - start == 1
+        assert events() == [utils.State.RUNNING, utils.State.SUCCESS]
+
+        folder = tempfile.mkdtemp()
+        try:
+            sink = models.FileEventLogSink(folder, flush_interval=0)
+            sink.record(Log(utils.State.FAILED, ti))
+            sink.flush()
+            assert len(os.listdir(folder)) == 1
+            assert models.FileEventLogSink.ship(folder) == 1
+            assert os.listdir(folder) == []
+        finally:
+            shutil.rmtree(folder)
+        assert events() == [
+            utils.State.RUNNING, utils.State.SUCCESS, utils.State.FAILED]
+        log = session.query(Log).filter(
+            Log.event == utils.State.FAILED,
+            Log.dag_id == dag.dag_id).first()
+        assert log.execution_date == DEFAULT_DATE
+        session.query(Log).filter(Log.dag_id == dag.dag_id).delete()
+        session.commit()
+        session.close()
+
+    def test_pool_slots_across_dag_processes(self):
+        session = settings.Session()
+        pool = models.Pool(pool='test_dag_processes_pool', slots=1)
+        session.add(pool)
+        start_date = datetime.now().replace(
+            hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        args = {'owner': 'airflow', 'start_date': start_date}
+        dags = []
+        for i in range(2):
+            dag = models.DAG(
+                'dag_processes_pool_test_{}'.format(i), default_args=args)
+            for j in range(2):
+                operators.DummyOperator(
+                    task_id='dummy_{}'.format(j), pool=pool.pool, dag=dag)
+            session.merge(models.DagModel(dag_id=dag.dag_id))
+            dags.append(dag)
+        session.commit()
+
+        class FakeDagBag(object):
+            pass
+        dagbag = FakeDagBag()
+        dagbag.dags = dict([(dag.dag_id, dag) for dag in dags])
+        job = jobs.SchedulerJob(test_mode=True, dag_processes=2)
+        job.state_index.full_sync(session)
+        executor = jobs.QueuedKeysCollector()
+        job.process_dags_in_pool(dags, dagbag, executor)
+        # Every worker sees the open slot, only one task instance gets it
+        assert len(executor.keys) == 1
+        for dag in dags:
+            assert 'process_dag.' + dag.dag_id in job.loop_stats
+
+        # The workers are kept for the following loops
+        dag_pool = job.dag_pool
+        job.slot_ledger = None
+        job.dags_processed_at = None
+        job.process_dags_in_pool(dags, dagbag, executor)
+        assert job.dag_pool is dag_pool
+        job.close_dag_pool()
+        assert job.dag_pool is None
+        session.delete(pool)
+        session.commit()
+        session.close()
+
+    def test_max_active_runs(self):
+        start_date = datetime.now().replace(
+            hour=0, minute=0, second=0, microsecond=0) - timedelta(days=10)
+        args = {'owner': 'airflow', 'start_date': start_date}
+        dag = models.DAG(
+            'max_active_runs_test', default_args=args, max_active_runs=3)
+        operators.DummyOperator(task_id='dummy', dag=dag)
+        job = jobs.SchedulerJob(dag_id=dag.dag_id, test_mode=True)
+        session = settings.Session()
+        job.state_index.full_sync(session)
+        session.close()
+        executor = jobs.QueuedKeysCollector()
+        job._process_dag(dag, executor)
+        assert executor.keys == [
+            (dag.dag_id, 'dummy', start_date + timedelta(days=i))
+            for i in range(3)]
+
+        # A blocked task doesn't keep the others from moving on
+        dag = models.DAG(
+            'max_active_runs_blocked_test', default_args=args,
+            max_active_runs=2)
+        failed = operators.DummyOperator(task_id='failed', dag=dag)
+        blocked = operators.DummyOperator(
+            task_id='blocked', depends_on_past=True, dag=dag)
+        blocked.set_upstream(failed)
+        operators.DummyOperator(task_id='independent', dag=dag)
+        session = settings.Session()
+        for i in range(5):
+            execution_date = start_date + timedelta(days=i)
+            for task_id in ('failed', 'independent'):
+                ti = models.TaskInstance(
+                    dag.get_task(task_id), execution_date)
+                ti.state = utils.State.SUCCESS
+                if task_id == 'failed' and i == 0:
+                    ti.state = utils.State.FAILED
+                session.merge(ti)
+        session.commit()
+        job = jobs.SchedulerJob(dag_id=dag.dag_id, test_mode=True)
+        job.state_index.full_sync(session)
+        session.close()
+        executor = jobs.QueuedKeysCollector()
+        job._process_dag(dag, executor)
+        assert sorted(executor.keys) == sorted([
+            (dag.dag_id, task_id, start_date + timedelta(days=i))
+            for task_id in ('failed', 'independent') for i in (5, 6)])
+
+        # New task instances take a slot in their pool
+        session = settings.Session()
+        pool = models.Pool(pool='max_active_runs_pool', slots=1)
+        session.add(pool)
+        session.commit()
+        dag = models.DAG(
+            'max_active_runs_pool_test', default_args=args,
+            max_active_runs=3)
+        operators.DummyOperator(task_id='pooled', pool=pool.pool, dag=dag)
+        job = jobs.SchedulerJob(dag_id=dag.dag_id, test_mode=True)
+        job.state_index.full_sync(session)
+        executor = jobs.QueuedKeysCollector()
+        job._process_dag(dag, executor)
+        assert executor.keys == [(dag.dag_id, 'pooled', start_date)]
+        session.delete(pool)
+        session.commit()
+        session.close()
+
+    def test_scheduler_wakeup(self):
+        wakeup = jobs.SchedulerWakeup('localhost', 18794, poll_interval=0.1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto(b'ti', ('localhost', 18794))
+        sock.close()
+        assert wakeup.wait(5) == 'task_instance'
+        assert wakeup.wait(0.2) is None
+
+        executor = executors.SequentialExecutor()
+        syncs = []
+        executor.sync = lambda: syncs.append(1)
+        assert wakeup.wait(0.3, executor=executor) is None
+        # Syncing the executor is left to its heartbeat
+        assert not syncs
+        executor.event_buffer[('dag_id', 'task_id', DEFAULT_DATE)] = 'success'
+        assert wakeup.wait(5, executor=executor) == 'executor'
+
+        # DAG file changes are only looked for when inotify reports them
+        class FakeDagBag(object):
+            pass
+        dagbag = FakeDagBag()
+        folder = tempfile.mkdtemp()
+        try:
+            for use_inotify in (False, True):
+                dagbag.watcher = models.DagFolderWatcher(
+                    folder, use_inotify=use_inotify)
+                dagbag.watcher.poll()
+                with open(os.path.join(folder, 'dag.py'), 'a') as f:
+                    f.write('\n')
+                reason = wakeup.wait(0.3, dagbag=dagbag)
+                if dagbag.watcher.inotify:
+                    assert reason == 'dag_file'
+                else:
+                    assert reason is None
+                dagbag.watcher.close()
+        finally:
+            shutil.rmtree(folder)
+        wakeup.close()
+
+    def test_record_heartbeat(self):
+        session = settings.Session()
+        running = jobs.BaseJob(state=utils.State.RUNNING)
+        shutdown = jobs.BaseJob(state=utils.State.SHUTDOWN)
+        session.add_all([running, shutdown])
+        session.commit()
+        latest_heartbeat = datetime(2015, 1, 2)
+        assert running.id and shutdown.id  # Loads the committed rows
+        start = utils.sql_statement_count()
+        assert not running.record_heartbeat(latest_heartbeat)
+        assert utils.sql_statement_count() - start == 1
+        assert shutdown.record_heartbeat(latest_heartbeat)
+        session.expire_all()
+        assert running.latest_heartbeat == latest_heartbeat
+        session.close()
+
+    def test_scheduler_shards(self):
+        dagbag = models.DagBag(
+            dag_folder=DEV_NULL, include_examples=True, sync_to_db=True)
+        session = settings.Session()
+        schedulers = [
+            jobs.SchedulerJob(shard_index=i, shard_count=3) for i in range(3)]
+        for job in schedulers:
+            job.refresh_shard(session)
+        session.close()
+        for dag_id, dag in dagbag.dags.items():
+            owners = [job for job in schedulers if job.owns_dag(dag_id)]
+            assert len(owners) == 1
+            assert owners[0].owns_file(dag.full_filepath)
+        ring = jobs.ShardRing([1, 2])
+        keys = ['dag_{}'.format(i) for i in range(100)]
+        moved = [k for k in keys if ring.get(k) != jobs.ShardRing([1]).get(k)]
+        assert set(moved) == set([k for k in keys if ring.get(k) == 2])
+
+    def test_parallel_dagbag(self):
+        dagbag = models.DagBag(
+            dag_folder=DEV_NULL, include_examples=True, parse_processes=2)
+        assert sorted(dagbag.dags) == sorted(self.dagbag.dags)
+        for dag_id, dag in dagbag.dags.items():
+            assert dag.task_ids == self.dagbag.dags[dag_id].task_ids
+            assert dag.full_filepath == self.dagbag.dags[dag_id].full_filepath
+        task = dagbag.dags['example_python_operator'].get_task('sleep_for_0')
+        task.execute(context={})
+
+    def test_dag_parse_cache(self):
+        folder = tempfile.mkdtemp()
+        filepath = self.dagbag.dags['example_bash_operator'].full_filepath
+        try:
+            cache = models.DagParseCache(folder)
+            dagbag = models.DagBag(
+                dag_folder=filepath, include_examples=False,
+                parse_cache=cache)
+            key = cache.key(filepath)
+            assert cache.get(key) is not None
+
+            # Every hit gets its own copy of the DAGs
+            memory_cache = models.DagParseCache()
+            for i in range(2):
+                models.DagBag(
+                    dag_folder=filepath, include_examples=False,
+                    parse_cache=memory_cache)
+            dags = memory_cache.get(key)
+            dags[0].get_task('runme_0').bash_command = 'echo changed'
+            assert memory_cache.get(key)[0] is not dags[0]
+            assert (
+                memory_cache.get(key)[0].get_task('runme_0').bash_command !=
+                'echo changed')
+
+            # A fresh cache reads the DAGs back from the folder
+            cache = models.DagParseCache(folder)
+            imported = []
+            load_source = imp.load_source
+            imp.load_source = lambda *args: imported.append(args)
+            try:
+                cached_dagbag = models.DagBag(
+                    dag_folder=filepath, include_examples=False,
+                    parse_cache=cache)
+            finally:
+                imp.load_source = load_source
+            assert not imported
+            assert (
+                cached_dagbag.dags['example_bash_operator'].task_ids ==
+                dagbag.dags['example_bash_operator'].task_ids)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_serialized_dag(self):
+        session = settings.Session()
+        session.query(models.SerializedDag).delete()
+        dags = self.dagbag.dags.values()
+        assert models.SerializedDag.write_dags(dags, session) == len(dags)
+        session.commit()
+        # Unchanged DAGs aren't written again
+        assert models.SerializedDag.write_dags(dags, session) == 0
+        session.commit()
+        session.close()
+
+        dagbag = models.SerializedDagBag()
+        assert sorted(dagbag.dags) == sorted(self.dagbag.dags)
+        for dag_id, dag in self.dagbag.dags.items():
+            serialized_dag = dagbag.get_dag(dag_id)
+            assert sorted(serialized_dag.task_ids) == sorted(dag.task_ids)
+            assert serialized_dag.schedule_interval == dag.schedule_interval
+            for task in dag.tasks:
+                serialized_task = serialized_dag.get_task(task.task_id)
+                assert serialized_task.task_type == task.__class__.__name__
+                assert serialized_task.ui_color == task.ui_color
+                assert (
+                    sorted([t.task_id for t in serialized_task.upstream_list])
+                    == sorted([t.task_id for t in task.upstream_list]))
+                for field in task.template_fields:
+                    assert (
+                        getattr(serialized_task, field) ==
+                        getattr(task, field))
+        assert 'example_bash_operator' in dagbag.get_dag(
+            'example_bash_operator').source_code
+
+        # Template fields are set on the deserialized tasks themselves
+        task = dagbag.get_dag('example_bash_operator').get_task('runme_0')
+        ti = models.TaskInstance(task=task, execution_date=DEFAULT_DATE)
+        ti.render_templates()
+        assert task.bash_command == (
+            'echo "example_bash_operator__runme_0__20150101" && sleep 0')
+
+        # The stored hashes are read once per freshness_ttl
+        dagbag = models.SerializedDagBag(freshness_ttl=60)
+        start = utils.sql_statement_count()
+        for i in range(3):
+            assert 'example_bash_operator' in dagbag.dags
+            assert dagbag.get_dag('example_bash_operator')
+        assert utils.sql_statement_count() == start
+        dagbag.expire_snapshot()
+        assert 'example_bash_operator' in dagbag.dags
+        assert utils.sql_statement_count() - start == 1
+
+    def test_dag_import_timeout(self):
+        folder = tempfile.mkdtemp()
+        filepath = os.path.join(folder, 'slow_dag.py')
+        dag_file = (
+            "from datetime import datetime\n"
+            "import time\n"
+            "from airflow import DAG\n"
+            "from airflow.operators import DummyOperator\n"
+            "time.sleep({})\n"
+            "dag = DAG('slow_dag', default_args={{\n"
+            "    'owner': 'airflow', 'start_date': datetime(2015, 1, 1)}})\n"
+            "DummyOperator(task_id='{}', dag=dag)\n")
+        try:
+            with open(filepath, 'w') as f:
+                f.write(dag_file.format(0, 'fast'))
+            dagbag = models.DagBag(
+                dag_folder=folder, include_examples=False,
+                parse_cache=False, import_timeout=1)
+            stats = dagbag.file_stats[filepath]
+            assert stats['dag_count'] == 1 and stats['task_count'] == 1
+            assert not stats['timed_out']
+
+            with open(filepath, 'w') as f:
+                f.write(dag_file.format(5, 'slow'))
+            dagbag.process_file(filepath, only_if_updated=False)
+            stats = dagbag.file_stats[filepath]
+            assert stats['timed_out'] and stats['duration'] < 5
+            # The DAG previously loaded from the file is kept
+            assert dagbag.get_dag('slow_dag').task_ids == ['fast']
+        finally:
+            shutil.rmtree(folder)
+
+    def test_dag_folder_watcher(self):
+        folder = tempfile.mkdtemp()
+        try:
+            for path in ('dag.py', 'ignored/dag.py', 'sub/dag.py'):
+                path = os.path.join(folder, path)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.mkdir(os.path.dirname(path))
+                with open(path, 'w') as f:
+                    f.write('')
+            with open(os.path.join(folder, '.airflowignore'), 'w') as f:
+                f.write('ignored\n')
+            for use_inotify in (True, False):
+                watcher = models.DagFolderWatcher(folder, use_inotify)
+                assert watcher.poll() == set([
+                    os.path.join(folder, 'dag.py'),
+                    os.path.join(folder, 'sub/dag.py')])
+                assert not watcher.has_changes()
+                for path in ('ignored/dag.py', 'sub/dag.py'):
+                    with open(os.path.join(folder, path), 'w') as f:
+                        f.write('# changed {}'.format(use_inotify))
+                    os.utime(os.path.join(folder, path), (0, use_inotify))
+                assert watcher.poll() == set([
+                    os.path.join(folder, 'sub/dag.py')])
+                watcher.close()
+        finally:
+            shutil.rmtree(folder)
+
+    def test_bulk_dag_sync(self):
+        DM = models.DagModel
+        session = settings.Session()
+        session.query(DM).filter(
+            DM.dag_id.in_(list(self.dagbag.dags) + ['deleted_dag']),
+        ).delete(synchronize_session=False)
+        session.add(DM(dag_id='example_bash_operator', fileloc='moved.py'))
+        session.add(DM(dag_id='deleted_dag', is_active=True))
+        session.commit()
+
+        dagbag = models.DagBag(
+            dag_folder=DEV_NULL, include_examples=True, sync_to_db=True)
+        # The rows stay pending when the transaction fails
+        dagbag.pending_orm_dags = {
+            'duplicate': {'dag_id': 'example_bash_operator'}}
+        try:
+            dagbag.sync_orm_dags()
+            assert False, "The insert should have failed"
+        except IntegrityError:
+            pass
+        assert 'duplicate' in dagbag.pending_orm_dags
+
+        start = utils.sql_statement_count()
+        dagbag.pending_orm_dags = dict([
+            (dag_id, {
+                'dag_id': dag_id, 'fileloc': dag.full_filepath,
+                'is_subdag': False, 'owners': dag.owner, 'is_active': True})
+            for dag_id, dag in dagbag.dags.items()])
+        dagbag.sync_orm_dags()
+        assert not dagbag.pending_orm_dags
+        # One select, one executemany for each of update and insert
+        assert utils.sql_statement_count() - start <= 3
+
+        orm_dags = dict([(d.dag_id, d) for d in session.query(DM)])
+        session.close()
+        assert not orm_dags['deleted_dag'].is_active
+        for dag_id, dag in dagbag.dags.items():
+            assert orm_dags[dag_id].is_active
+            assert orm_dags[dag_id].fileloc == dag.full_filepath
+
+    def test_get_dag_freshness(self):
+        dagbag = models.DagBag(
+            dag_folder=DEV_NULL, include_examples=True, sync_to_db=True,
+            freshness_ttl=3600)
+        dag = dagbag.get_dag('example_bash_operator')
+        start = utils.sql_statement_count()
+        for i in range(10):
+            for dag_id in dagbag.dags:
+                assert dagbag.get_dag(dag_id) is dagbag.dags[dag_id]
+        # The expiry dates are read once, DAGs that weren't expired aren't
+        # imported again
+        assert utils.sql_statement_count() - start == 0
+        assert dagbag.get_dag('example_bash_operator') is dag
+
+        session = settings.Session()
+        orm_dag = session.query(models.DagModel).filter(
+            models.DagModel.dag_id == 'example_bash_operator').first()
+        orm_dag.last_expired = datetime.now()
+        session.commit()
+        session.close()
+        assert dagbag.get_dag('example_bash_operator') is dag
+        dagbag.expire_snapshot()
+        assert dagbag.get_dag('example_bash_operator') is not dag
+
+    def test_lazy_operators(self):
+        assert isinstance(operators, utils.LazyModule)
+        assert operators.DummyOperator.__module__ == 'dummy_operator'
+        assert 'DummyOperator' in operators.__all__
+        try:
+            operators.NotAnOperator
+            assert False
+        except AttributeError:
+            pass
+        # Pickled DAGs refer to the operator modules as top level modules
+        assert __import__('bash_operator').BashOperator is (
+            operators.BashOperator)
+
+    def test_dagbag_for_dag(self):
+        models.DagBag(dag_folder=DEV_NULL, sync_to_db=True)
+        dagbag = models.DagBag.for_dag('example_bash_operator', DEV_NULL)
+        assert dagbag.dags.keys() == ['example_bash_operator']
+        # DAGs that aren't known get looked for in the whole folder
+        dagbag = models.DagBag.for_dag('unknown_dag', DEV_NULL)
+        assert sorted(dagbag.dags) == sorted(self.dagbag.dags)
+
     def test_local_backfill_job(self):
         self.dag_bash.clear(
             start_date=DEFAULT_DATE,
@@ -253,6 +1095,8 @@ class WebUiTests(unittest.TestCase):
             'task_id=runme_0&dag_id=example_bash_operator&'
             'execution_date=2015-01-01')
         assert "Attributes" in response.data
+        response = self.app.get('/admin/pool/')
+        assert "Pools" in response.data
         response = self.app.get(
             '/admin/airflow/dag_stats')
         assert "example_bash_operator" in response.data